@@ -3,8 +3,17 @@ Multi-Agent System for English Tutoring
 Compatible with existing Chatbot-Messenger project
 """
 
-from typing import Dict, Any
+import hashlib
+import re
+import sys
+from functools import lru_cache
+from typing import Dict, Any, ClassVar, Iterator, List
 from enum import Enum
+import google.generativeai as genai
+import numpy as np
+
+from backend.utils.retry import with_retry, CircuitOpenError, GEMINI_BREAKER
+from backend.utils.semantic_cache import SemanticResponseCache
 
 
 class AgentType(Enum):
@@ -15,47 +24,121 @@ class AgentType(Enum):
     EXERCISE_GENERATOR = "exercise_generator"
 
 
+ROLE_LABELS = {"user": "Học sinh"}  # Anything else is the assistant
+
+
+@lru_cache(maxsize=32)
+def _render_history(turns: tuple, max_chars: int) -> str:
+    return "".join([
+        f"{ROLE_LABELS.get(role, 'Trợ lý')}: {content[:max_chars]}...\n"
+        for role, content in turns
+    ])
+
+
+def format_history(history, limit: int = 6, max_chars: int = 150) -> str:
+    """
+    Render the last `limit` messages as "Role: content..." lines
+    
+    Memoized on the message contents, so agents formatting the same window
+    in one turn (fan-out, reflection) share the rendered block.
+    """
+    window = list(history)[-limit:]
+    return _render_history(tuple((m["role"], m["content"]) for m in window), max_chars)
+
+
 class BaseAgent:
     """Base agent class"""
     
+    # Static prompt pieces, defined once per subclass (shared by every instance)
+    SYSTEM_PROMPT: ClassVar[str]
+    RAG_HEADER: ClassVar[str] = ""
+    TASK_PROMPT: ClassVar[str] = ""
+    
     def __init__(self, agent_type: AgentType, model):
         self.agent_type = agent_type
         self.model = model
-        self.system_prompt = self._get_system_prompt()
+        self.system_prompt = type(self).SYSTEM_PROMPT
+        self._prefix_model = None
     
-    def _get_system_prompt(self) -> str:
-        raise NotImplementedError
+    @property
+    def prefix_model(self):
+        """Model with the static system prompt as a fixed prefix (built once)"""
+        if self._prefix_model is None:
+            # Agent prompts are far below the explicit CachedContent minimum; a stable
+            # system_instruction prefix still gets Gemini's implicit prefix caching
+            self._prefix_model = genai.GenerativeModel(
+                self.model.model_name,
+                system_instruction=self.system_prompt
+            )
+        return self._prefix_model
     
     def _build_prompt_with_history(self, query: str, context: Dict[str, Any]) -> str:
-        """Build prompt including conversation history"""
-        prompt = f"{self.system_prompt}\n\n"
+        """Build the dynamic part of the prompt (system prompt lives in prefix_model)"""
+        parts = []
         
-        # Add conversation history if available
-        if context and "conversation_history" in context:
-            history = context["conversation_history"]
-            if len(history) > 0:
-                prompt += "📜 **Lịch sử hội thoại gần đây:**\n"
-                for msg in history[-6:]:  # Last 3 exchanges (6 messages)
-                    role = "Học sinh" if msg["role"] == "user" else "Trợ lý"
-                    prompt += f"{role}: {msg['content'][:150]}...\n"
-                prompt += "\n"
+        # Add conversation history if available (last 3 exchanges)
+        history = context.get("conversation_history") if context else None
+        if history:
+            parts += ["📜 **Lịch sử hội thoại gần đây:**\n", format_history(history, 6, 150), "\n"]
         
-        prompt += f"🎯 **Câu hỏi hiện tại:** \"{query}\"\n\n"
+        parts += ["🎯 **Câu hỏi hiện tại:** \"", query, "\"\n\n"]
         
-        return prompt
+        return "".join(parts)
+    
+    def _build_prompt(self, query: str, context: Dict[str, Any] = None) -> str:
+        """History + top RAG snippets under RAG_HEADER + TASK_PROMPT"""
+        parts = [self._build_prompt_with_history(query, context)]
+        
+        # Add RAG results if available
+        rag_results = context.get("rag_results") if context else None
+        if rag_results:
+            parts.append(self.RAG_HEADER)
+            parts += [f"- {r['document'][:200]}...\n" for r in rag_results[:2]]
+            parts.append("\n")
+        
+        parts.append(self.TASK_PROMPT)
+        
+        return "".join(parts)
+    
+    def _on_response(self, response_text: str, context: Dict[str, Any] = None):
+        """Hook called with the full response text (override to keep state)"""
+        pass
+    
+    @with_retry(breaker=GEMINI_BREAKER)
+    def _generate(self, prompt: str, context: Dict[str, Any] = None, stream: bool = False):
+        """Send the prompt to Gemini (override to use a chat session)"""
+        return self.prefix_model.generate_content(prompt, stream=stream)
     
     def process(self, query: str, context: Dict[str, Any] = None) -> Dict[str, Any]:
-        raise NotImplementedError
+        prompt = self._build_prompt(query, context)
+        
+        try:
+            response = self._generate(prompt, context)
+            self._on_response(response.text, context)
+            return {
+                "success": True,
+                "agent": self.agent_type.value,
+                "response": response.text
+            }
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+    
+    def process_stream(self, query: str, context: Dict[str, Any] = None) -> Iterator[str]:
+        """Yield response text chunks as Gemini generates them"""
+        prompt = self._build_prompt(query, context)
+        
+        chunks = []
+        for chunk in self._generate(prompt, context, stream=True):
+            chunks.append(chunk.text)
+            yield chunk.text
+        
+        self._on_response("".join(chunks), context)
 
 
 class GrammarExpertAgent(BaseAgent):
     """Grammar specialist"""
     
-    def __init__(self, model):
-        super().__init__(AgentType.GRAMMAR_EXPERT, model)
-    
-    def _get_system_prompt(self) -> str:
-        return """Bạn là giáo viên ngữ pháp tiếng Anh chuyên nghiệp với 20+ năm kinh nghiệm.
+    SYSTEM_PROMPT: ClassVar[str] = sys.intern("""Bạn là giáo viên ngữ pháp tiếng Anh chuyên nghiệp với 20+ năm kinh nghiệm.
 
 Chuyên môn:
 - Giải thích quy tắc ngữ pháp rõ ràng, súc tích
@@ -72,44 +155,23 @@ Phong cách giảng dạy:
 Cấu trúc:
 1. Formula/Rule → Examples → Common Mistakes → Tips
 2. Dùng bullet points và format rõ ràng
-3. Khuyến khích và kiên nhẫn"""
+3. Khuyến khích và kiên nhẫn""")
     
-    def process(self, query: str, context: Dict[str, Any] = None) -> Dict[str, Any]:
-        # Build prompt with history
-        prompt = self._build_prompt_with_history(query, context)
-        
-        # Add RAG results if available
-        if context and "rag_results" in context and len(context["rag_results"]) > 0:
-            prompt += "📚 **Kiến thức ngữ pháp liên quan:**\n"
-            for r in context["rag_results"][:2]:
-                prompt += f"- {r['document'][:200]}...\n"
-            prompt += "\n"
-        
-        prompt += """✍️ **Nhiệm vụ của bạn:**
+    RAG_HEADER: ClassVar[str] = "📚 **Kiến thức ngữ pháp liên quan:**\n"
+    TASK_PROMPT: ClassVar[str] = sys.intern("""✍️ **Nhiệm vụ của bạn:**
     Dựa vào lịch sử hội thoại (nếu có), hãy trả lời câu hỏi hiện tại một cách mạch lạc.
     Nếu câu hỏi liên quan đến câu trước, hãy kết nối với ngữ cảnh đã thảo luận.
 
-    Hãy đưa ra giải thích có cấu trúc rõ ràng:"""
-        
-        try:
-            response = self.model.generate_content(prompt)
-            return {
-                "success": True,
-                "agent": self.agent_type.value,
-                "response": response.text
-            }
-        except Exception as e:
-            return {"success": False, "error": str(e)}
+    Hãy đưa ra giải thích có cấu trúc rõ ràng:""")
+    
+    def __init__(self, model):
+        super().__init__(AgentType.GRAMMAR_EXPERT, model)
 
 
 class VocabularyExpertAgent(BaseAgent):
     """Vocabulary specialist"""
     
-    def __init__(self, model):
-        super().__init__(AgentType.VOCABULARY_EXPERT, model)
-    
-    def _get_system_prompt(self) -> str:
-        return """Bạn là giáo viên từ vựng tiếng Anh chuyên gia.
+    SYSTEM_PROMPT: ClassVar[str] = sys.intern("""Bạn là giáo viên từ vựng tiếng Anh chuyên gia.
 
 Chuyên môn:
 - Giải thích nghĩa từ đơn giản
@@ -124,43 +186,29 @@ Cấu trúc giải thích:
 3. Collocations phổ biến
 4. Synonyms/Antonyms
 5. Word family (verb, noun, adj, adv)
-6. Memory trick"""
+6. Memory trick""")
     
-    def process(self, query: str, context: Dict[str, Any] = None) -> Dict[str, Any]:
-        prompt = self._build_prompt_with_history(query, context)
-        
-        if context and "rag_results" in context and len(context["rag_results"]) > 0:
-            prompt += "📖 **Thông tin từ điển:**\n"
-            for r in context["rag_results"][:2]:
-                prompt += f"- {r['document'][:200]}...\n"
-            prompt += "\n"
-        
-        prompt += """✍️ **Nhiệm vụ của bạn:**
+    RAG_HEADER: ClassVar[str] = "📖 **Thông tin từ điển:**\n"
+    TASK_PROMPT: ClassVar[str] = sys.intern("""✍️ **Nhiệm vụ của bạn:**
     Dựa vào lịch sử hội thoại, trả lời câu hỏi về từ vựng một cách toàn diện.
     Nếu câu hỏi liên quan đến từ đã học trước đó, hãy kết nối với kiến thức đã thảo luận.
 
-    Hãy đưa ra bài học từ vựng chi tiết:"""
-        
-        try:
-            response = self.model.generate_content(prompt)
-            return {
-                "success": True,
-                "agent": self.agent_type.value,
-                "response": response.text
-            }
-        except Exception as e:
-            return {"success": False, "error": str(e)}
+    Hãy đưa ra bài học từ vựng chi tiết:""")
+    
+    def __init__(self, model):
+        super().__init__(AgentType.VOCABULARY_EXPERT, model)
 
 
 class ConversationPartnerAgent(BaseAgent):
     """Conversation partner"""
     
-    def __init__(self, model):
-        super().__init__(AgentType.CONVERSATION_PARTNER, model)
-        self.history = []
+    # History only grows between resets, so consecutive prompts share a stable
+    # prefix (provider prefix cache hits); at a reset older turns collapse into a recap
+    HISTORY_RESET_LIMIT = 20  # Messages before a reset (10 exchanges)
+    HISTORY_KEEP = 4  # Recent messages kept verbatim after a reset (2 exchanges)
+    SUMMARY_KEEP = 3  # Recaps kept in the running summary (oldest dropped)
     
-    def _get_system_prompt(self) -> str:
-        return """Bạn là người bạn luyện tiếng Anh thân thiện, kiên nhẫn.
+    SYSTEM_PROMPT: ClassVar[str] = sys.intern("""Bạn là người bạn luyện tiếng Anh thân thiện, kiên nhẫn.
 
 Vai trò:
 - Tham gia hội thoại tự nhiên
@@ -179,41 +227,95 @@ Khi học sinh mắc lỗi:
 2. Chỉ ra lỗi nhẹ nhàng
 3. Đưa ra dạng đúng
 4. Giải thích ngắn gọn
-5. Tiếp tục cuộc trò chuyện"""
+5. Tiếp tục cuộc trò chuyện""")
     
-    def process(self, query: str, context: Dict[str, Any] = None) -> Dict[str, Any]:
+    def __init__(self, model):
+        super().__init__(AgentType.CONVERSATION_PARTNER, model)
+        self.history = []
+        self._history_summary = ""
+    
+    def start_chat(self):
+        """Create a per-user Gemini chat session with the system prompt built in"""
+        return self.prefix_model.start_chat(history=[])
+    
+    def _build_prompt(self, query: str, context: Dict[str, Any] = None) -> str:
+        # Chat session keeps system prompt and history: send only the new message
+        if self._uses_chat(context):
+            return query
+        
         self.history.append({"role": "user", "message": query})
         
-        prompt = f"""{self.system_prompt}
-
-Lịch sử hội thoại:
-"""
-        for msg in self.history[-6:]:
-            prompt += f"{msg['role'].title()}: {msg['message']}\n"
+        if len(self.history) > self.HISTORY_RESET_LIMIT:
+            dropped = self.history[:-self.HISTORY_KEEP]
+            self.history = self.history[-self.HISTORY_KEEP:]
+            self._history_summary = self._summarize(
+                [(m["role"], m["message"]) for m in dropped], self._history_summary
+            )
         
-        prompt += "\nHãy phản hồi tự nhiên và hữu ích:"
+        parts = ["Lịch sử hội thoại:\n"]
+        if self._history_summary:
+            parts.append(f"{self._history_summary}\n")
+        parts += [f"{msg['role'].title()}: {msg['message']}\n" for msg in self.history]
+        parts.append("\nHãy phản hồi tự nhiên và hữu ích:")
         
+        return "".join(parts)
+    
+    @staticmethod
+    def _summarize(messages: List[tuple], previous: str = "") -> str:
+        """Cheap recap of dropped turns (the student's lines, truncated) - no extra LLM call"""
+        topics = "; ".join(content[:80] for role, content in messages if role == "user")
+        recap = f"(Tóm tắt các lượt trước - học sinh đã nói: {topics})"
+        recaps = previous.split("\n") if previous else []
+        return "\n".join(recaps[-(ConversationPartnerAgent.SUMMARY_KEEP - 1):] + [recap])
+    
+    @staticmethod
+    def _uses_chat(context: Dict[str, Any] = None) -> bool:
+        return bool(context) and context.get("chat_session") is not None
+    
+    def _on_response(self, response_text: str, context: Dict[str, Any] = None):
+        # Chat sessions hold their own history; self.history is only for stateless calls
+        if not self._uses_chat(context):
+            self.history.append({"role": "assistant", "message": response_text})
+    
+    @staticmethod
+    def _chat_history(chat) -> list:
+        """Session history, rewinding a last turn broken by a failed or blocked reply"""
         try:
-            response = self.model.generate_content(prompt)
-            self.history.append({"role": "assistant", "message": response.text})
-            
-            return {
-                "success": True,
-                "agent": self.agent_type.value,
-                "response": response.text
-            }
-        except Exception as e:
-            return {"success": False, "error": str(e)}
+            return chat.history
+        except (genai.types.BrokenResponseError, genai.types.IncompleteIterationError):
+            chat.rewind()
+            return chat.history
+    
+    def _trim_chat(self, chat):
+        """Reset an over-long session to a recap + the last few messages"""
+        history = self._chat_history(chat)
+        if len(history) <= self.HISTORY_RESET_LIMIT:
+            return
+        
+        dropped = history[:-self.HISTORY_KEEP]
+        recap = self._summarize(
+            [("user" if c.role == "user" else "model", c.parts[0].text) for c in dropped if c.parts]
+        )
+        chat.history = [
+            {"role": "user", "parts": [recap]},
+            {"role": "model", "parts": ["OK, let's continue our conversation."]},
+            *history[-self.HISTORY_KEEP:]
+        ]
+    
+    @with_retry(breaker=GEMINI_BREAKER)
+    def _generate(self, prompt: str, context: Dict[str, Any] = None, stream: bool = False):
+        chat = context.get("chat_session") if context else None
+        if chat is None:
+            return self.prefix_model.generate_content(prompt, stream=stream)
+        
+        self._trim_chat(chat)
+        return chat.send_message(prompt, stream=stream)
 
 
 class ExerciseGeneratorAgent(BaseAgent):
     """Exercise generator"""
     
-    def __init__(self, model):
-        super().__init__(AgentType.EXERCISE_GENERATOR, model)
-    
-    def _get_system_prompt(self) -> str:
-        return """Bạn là chuyên gia tạo bài tập tiếng Anh hiệu quả.
+    SYSTEM_PROMPT: ClassVar[str] = sys.intern("""Bạn là chuyên gia tạo bài tập tiếng Anh hiệu quả.
 
 Chuyên môn:
 - Thiết kế bài tập phù hợp với trình độ
@@ -229,91 +331,293 @@ Câu hỏi:
 1. ...
 2. ...
 Đáp án:
-1. ... (Giải thích: ...)"""
+1. ... (Giải thích: ...)""")
     
-    def process(self, query: str, context: Dict[str, Any] = None) -> Dict[str, Any]:
-        prompt = self._build_prompt_with_history(query, context)
-        
-        if context and "rag_results" in context and len(context["rag_results"]) > 0:
-            prompt += "📝 **Tham khảo bài tập mẫu:**\n"
-            for r in context["rag_results"][:2]:
-                prompt += f"- {r['document'][:200]}...\n"
-            prompt += "\n"
-        
-        prompt += """✍️ **Nhiệm vụ của bạn:**
+    RAG_HEADER: ClassVar[str] = "📝 **Tham khảo bài tập mẫu:**\n"
+    TASK_PROMPT: ClassVar[str] = sys.intern("""✍️ **Nhiệm vụ của bạn:**
     Dựa vào lịch sử hội thoại (chủ đề đã học), tạo bài tập phù hợp.
 
     Hãy tạo 3-5 bài tập bao gồm:
     1. Hướng dẫn rõ ràng
     2. Câu hỏi
-    3. Đáp án kèm giải thích"""
-        
-        try:
-            response = self.model.generate_content(prompt)
-            return {
-                "success": True,
-                "agent": self.agent_type.value,
-                "response": response.text
-            }
-        except Exception as e:
-            return {"success": False, "error": str(e)}
+    3. Đáp án kèm giải thích""")
+    
+    def __init__(self, model):
+        super().__init__(AgentType.EXERCISE_GENERATOR, model)
 
 
 class AgentRouter:
     """Routes queries to appropriate agent"""
     
+    # Stateless agents whose answers can be reused for near-duplicate questions
+    # (exercises are meant to vary, so they are never cached)
+    CACHEABLE_AGENTS = {
+        AgentType.GRAMMAR_EXPERT,
+        AgentType.VOCABULARY_EXPERT
+    }
+    
+    # Routing keywords, checked in priority order
+    ROUTING_KEYWORDS = {
+        AgentType.EXERCISE_GENERATOR: ['bài tập', 'exercise', 'practice', 'quiz', 'test',
+                                       'generate', 'tạo', 'làm'],
+        AgentType.VOCABULARY_EXPERT: ['nghĩa', 'mean', 'meaning', 'what is', 'what does',
+                                      'từ', 'word', 'vocabulary', 'synonym'],
+        AgentType.GRAMMAR_EXPERT: ['thì', 'tense', 'grammar', 'conditional', 'passive',
+                                   'ngữ pháp', 'câu điều kiện', 'giải thích', 'explain'],
+        AgentType.CONVERSATION_PARTNER: ['chat', 'talk', 'conversation', 'trò chuyện', 'nói chuyện']
+    }
+    
+    # Example queries per agent; their mean embedding is the intent centroid
+    INTENT_EXEMPLARS = {
+        AgentType.EXERCISE_GENERATOR: [
+            "Tạo bài tập về thì hiện tại hoàn thành",
+            "Give me a quiz on prepositions",
+            "Cho tôi vài câu trắc nghiệm để luyện tập",
+            "Make fill-in-the-blank exercises about articles",
+            "Tôi muốn làm bài tập câu bị động",
+            "Test me on irregular verbs",
+            "Practice questions for conditionals please",
+            "Ra đề kiểm tra ngữ pháp cho tôi",
+            "Generate 5 multiple choice questions",
+            "Kiểm tra xem tôi nhớ từ vựng chưa"
+        ],
+        AgentType.VOCABULARY_EXPERT: [
+            "What does ubiquitous mean?",
+            "Nghĩa của từ 'resilient' là gì?",
+            "Từ đồng nghĩa với happy",
+            "How do I use the word 'despite' in a sentence?",
+            "Collocations with 'make' and 'do'",
+            "Phân biệt affect và effect",
+            "What is the opposite of generous?",
+            "Word family of 'decide'",
+            "Dịch từ này sang tiếng Việt giúp tôi",
+            "Cách nhớ từ vựng hiệu quả"
+        ],
+        AgentType.GRAMMAR_EXPERT: [
+            "Giải thích thì hiện tại hoàn thành",
+            "When do I use present perfect vs past simple?",
+            "Explain the second conditional",
+            "Câu bị động dùng như thế nào?",
+            "Khi nào dùng a, an, the?",
+            "Is it 'fewer' or 'less' here?",
+            "Cấu trúc câu tường thuật",
+            "Why is it 'has gone' and not 'went'?",
+            "Sửa lỗi ngữ pháp trong câu này",
+            "Relative clauses with who, which, that"
+        ],
+        AgentType.CONVERSATION_PARTNER: [
+            "Let's chat about your weekend",
+            "Trò chuyện với tôi bằng tiếng Anh nhé",
+            "Hi! How are you today?",
+            "I want to practice speaking about my hobbies",
+            "Nói chuyện về du lịch đi",
+            "Can we talk about movies?",
+            "Tell me about your favorite food",
+            "I went to the beach yesterday and it was fun",
+            "Let's role-play ordering at a restaurant",
+            "Hỏi tôi vài câu về công việc của tôi"
+        ]
+    }
+    INTENT_MIN_SCORE = 0.35  # Below this the query matches no intent; use the default agent
+    
+    # Served while the Gemini circuit is open
+    FALLBACK_RESPONSE = "⚠️ Hệ thống AI đang tạm thời quá tải, vui lòng thử lại sau ít phút."
+    
     def __init__(self, model):
         self.model = model
-        self.agents = {
-            AgentType.GRAMMAR_EXPERT: GrammarExpertAgent(model),
-            AgentType.VOCABULARY_EXPERT: VocabularyExpertAgent(model),
-            AgentType.CONVERSATION_PARTNER: ConversationPartnerAgent(model),
-            AgentType.EXERCISE_GENERATOR: ExerciseGeneratorAgent(model)
+        
+        # Agents are built on first use (most sessions only hit one or two)
+        self._agent_factories = {
+            AgentType.GRAMMAR_EXPERT: GrammarExpertAgent,
+            AgentType.VOCABULARY_EXPERT: VocabularyExpertAgent,
+            AgentType.CONVERSATION_PARTNER: ConversationPartnerAgent,
+            AgentType.EXERCISE_GENERATOR: ExerciseGeneratorAgent
         }
+        self._agents: Dict[AgentType, BaseAgent] = {}
+        
+        self.semantic_cache = None
+        
+        # Embedding-based routing (enabled by enable_embeddings)
+        self._embed_query = None
+        self._intent_types = list(self.INTENT_EXEMPLARS)
+        self._intent_matrix = None
+        
+        # One alternation with a named group per agent, in priority order.
+        # The lookahead lets overlapping keywords from different agents all match.
+        alternation = "|".join(
+            f"(?P<{agent_type.name}>{'|'.join(map(re.escape, keywords))})"
+            for agent_type, keywords in self.ROUTING_KEYWORDS.items()
+        )
+        self._router_re = re.compile(f"(?=(?:{alternation}))", re.IGNORECASE)
     
-    def route(self, query: str) -> AgentType:
-        """Determine which agent to use"""
-        query_lower = query.lower()
+    def enable_embeddings(self, embedding_function, cache_threshold: float = 0.95):
+        """
+        Use the shared sentence encoder for intent routing and the semantic
+        response cache (no-op if already enabled)
+        """
+        if self._embed_query is not None:
+            return
         
-        # Grammar keywords
-        grammar_kw = ['thì', 'tense', 'grammar', 'conditional', 'passive', 
-                      'ngữ pháp', 'câu điều kiện', 'giải thích', 'explain']
+        @lru_cache(maxsize=256)
+        def embed_query(text: str) -> np.ndarray:
+            # Routing and cache lookup embed the same query once
+            vec = np.asarray(embedding_function([text])[0], dtype=np.float32)
+            return vec / (np.linalg.norm(vec) or 1.0)
         
-        # Vocabulary keywords
-        vocab_kw = ['nghĩa', 'mean', 'meaning', 'what is', 'what does',
-                    'từ', 'word', 'vocabulary', 'synonym']
+        self._embed_query = embed_query
+        self.semantic_cache = SemanticResponseCache(threshold=cache_threshold)
         
-        # Exercise keywords
-        exercise_kw = ['bài tập', 'exercise', 'practice', 'quiz', 'test',
-                       'generate', 'tạo', 'làm']
+        try:
+            self._intent_matrix = self._build_intent_centroids(embedding_function)
+        except Exception:
+            pass  # Keyword routing only
+    
+    def _build_intent_centroids(self, embedding_function) -> np.ndarray:
+        """Mean exemplar embedding per agent type, one unit row each ([n_agents, dim])"""
+        texts = [text for at in self._intent_types for text in self.INTENT_EXEMPLARS[at]]
+        vecs = np.asarray(embedding_function(texts), dtype=np.float32)
+        vecs /= np.linalg.norm(vecs, axis=1, keepdims=True)
         
-        # Conversation keywords
-        conv_kw = ['chat', 'talk', 'conversation', 'trò chuyện', 'nói chuyện']
+        centroids, start = [], 0
+        for at in self._intent_types:
+            end = start + len(self.INTENT_EXEMPLARS[at])
+            centroids.append(vecs[start:end].mean(axis=0))
+            start = end
         
-        if any(kw in query_lower for kw in exercise_kw):
-            return AgentType.EXERCISE_GENERATOR
+        matrix = np.stack(centroids)
+        return matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+    
+
+    def _cache_lookup(self, query: str, agent_type: AgentType, context: Dict[str, Any] = None):
+        """Return (cached_response, cache_key); both None when caching doesn't apply"""
+        if self.semantic_cache is None or agent_type not in self.CACHEABLE_AGENTS:
+            return None, None
         
-        if any(kw in query_lower for kw in vocab_kw):
-            return AgentType.VOCABULARY_EXPERT
+        # Follow-ups depend on the history, and the English-only encoder can't
+        # tell apart Vietnamese templates that differ in one word
+        if (context and context.get("conversation_history")) or not query.isascii():
+            return None, None
         
-        if any(kw in query_lower for kw in grammar_kw):
-            return AgentType.GRAMMAR_EXPERT
+        try:
+            vec = self._embed_query(query)
+        except Exception:
+            return None, None
         
-        if any(kw in query_lower for kw in conv_kw):
-            return AgentType.CONVERSATION_PARTNER
+        # Same question over different retrieved snippets is a different prompt
+        rag_results = context.get("rag_results") if context else None
+        digest = hashlib.blake2b(digest_size=8)
+        for r in rag_results or []:
+            digest.update(r["document"].encode("utf-8"))
+        tag = f"{agent_type.value}:{digest.hexdigest()}"
+        
+        return self.semantic_cache.get(vec, tag), (vec, tag)
+    
+    def _fallback_result(self, agent_type: AgentType) -> Dict[str, Any]:
+        """process_query result served instead of calling Gemini"""
+        return {
+            "success": True,
+            "agent": agent_type.value,
+            "response": self.FALLBACK_RESPONSE,
+            "routed_to": agent_type.value,
+            "fallback": True
+        }
+    
+    def route(self, query: str) -> AgentType:
+        """Determine which agent to use"""
+        agent_type = self._keyword_route(query)
+        if agent_type is not None:
+            return agent_type
+        
+        # No keyword hit: the centroid classifier decides, but only for English
+        # queries (the encoder is English-only, Vietnamese scores are near-noise)
+        if self._intent_matrix is not None and query.isascii():
+            try:
+                agent_type = self._classify_intent(query)
+            except Exception:
+                agent_type = None
+            if agent_type is not None:
+                return agent_type
         
         return AgentType.GRAMMAR_EXPERT
     
-    def process_query(self, query: str, context: Dict[str, Any] = None) -> Dict[str, Any]:
-        """Route and process query"""
-        agent_type = self.route(query)
-        agent = self.agents[agent_type]
+    def _classify_intent(self, query: str) -> AgentType:
+        """Agent whose intent centroid is closest to the query, or None if none is close"""
+        scores = self._intent_matrix @ self._embed_query(query)
+        best = int(np.argmax(scores))
+        return self._intent_types[best] if scores[best] >= self.INTENT_MIN_SCORE else None
+    
+    def _keyword_route(self, query: str) -> AgentType:
+        """Highest-priority keyword-matching agent type, or None"""
+        matched = {m.lastgroup for m in self._router_re.finditer(query)}
+        
+        return next((at for at in self.ROUTING_KEYWORDS if at.name in matched), None)
+    
+    def process_query(self, query: str, context: Dict[str, Any] = None,
+                      agent_type: AgentType = None) -> Dict[str, Any]:
+        """Route and process query (skip routing if agent_type is given)"""
+        if agent_type is None:
+            agent_type = self.route(query)
+        agent = self.get_agent(agent_type)
+        
+        cached, key = self._cache_lookup(query, agent_type, context)
+        if cached is not None:
+            return {
+                "success": True,
+                "agent": agent_type.value,
+                "response": cached,
+                "routed_to": agent_type.value,
+                "cached": True
+            }
+        
+        if GEMINI_BREAKER.is_open:
+            return self._fallback_result(agent_type)
         
         result = agent.process(query, context)
+        if not result["success"] and GEMINI_BREAKER.is_open:
+            return self._fallback_result(agent_type)
         result["routed_to"] = agent_type.value
         
+        if key is not None and result["success"]:
+            self.semantic_cache.put(*key, result["response"])
+        
         return result
     
+    def process_query_stream(self, query: str, context: Dict[str, Any] = None,
+                             agent_type: AgentType = None) -> Iterator[str]:
+        """Route and stream the response text chunk by chunk"""
+        if agent_type is None:
+            agent_type = self.route(query)
+        
+        cached, key = self._cache_lookup(query, agent_type, context)
+        if cached is not None:
+            yield cached
+            return
+        
+        if GEMINI_BREAKER.is_open:
+            yield self.FALLBACK_RESPONSE
+            return
+        
+        chunks = []
+        try:
+            for chunk in self.get_agent(agent_type).process_stream(query, context):
+                chunks.append(chunk)
+                yield chunk
+        except CircuitOpenError:
+            if not chunks:
+                yield self.FALLBACK_RESPONSE
+                return
+            raise
+        
+        if key is not None:
+            self.semantic_cache.put(*key, "".join(chunks))
+    
+    def start_chat(self):
+        """Create a Gemini chat session for the conversation partner (one per user)"""
+        return self.get_agent(AgentType.CONVERSATION_PARTNER).start_chat()
+    
     def get_agent(self, agent_type: AgentType):
-        """Get specific agent"""
-        return self.agents.get(agent_type)
\ No newline at end of file
+        """Get specific agent (constructed on first request)"""
+        agent = self._agents.get(agent_type)
+        if agent is None and agent_type in self._agent_factories:
+            agent = self._agents.setdefault(agent_type, self._agent_factories[agent_type](self.model))
+        return agent
\ No newline at end of file
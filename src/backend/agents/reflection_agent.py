@@ -2,21 +2,54 @@
 Reflection Agent - Self-critique and improvement
 """
 
+import re
 from typing import Dict, Any
 import google.generativeai as genai
 
+from backend.agents.multi_agent import format_history
+from backend.utils.retry import with_retry, GEMINI_BREAKER
+
+
+# Field labels from the "Format trả lời" block of the reflection prompt
+_REFLECTION_FIELD_RE = re.compile(r"(Confidence Score|Needs Improvement|Critique|Improved Response):")
+_NUMBER_RE = re.compile(r"\d*\.?\d+")
+
 
 class ReflectionAgent:
     """Agent that reflects on and improves responses"""
     
+    # Local confidence check: long answers with several bullet/numbered lines skip the critique call
+    CONFIDENT_MIN_CHARS = 400
+    CONFIDENT_MIN_ITEMS = 3
+    _LIST_ITEM_RE = re.compile(r"^\s*(?:[-*•]|\d+[.)])\s+", re.MULTILINE)
+    
     def __init__(self, model: genai.GenerativeModel):
         self.model = model
     
+    def looks_confident(self, response: str) -> bool:
+        """Cheap heuristic: is the response long and structured enough to skip reflection?"""
+        return (len(response) >= self.CONFIDENT_MIN_CHARS and
+                len(self._LIST_ITEM_RE.findall(response)) >= self.CONFIDENT_MIN_ITEMS)
+    
     def reflect_and_improve(self, original_query: str, original_response: str, 
                         agent_type: str, conversation_history: list = None) -> Dict[str, Any]:
         """
         Reflect on response quality with conversation context
         """
+        reflection_prompt = self._build_reflection_prompt(
+            original_query, original_response, agent_type, conversation_history
+        )
+        
+        try:
+            reflection = self._generate(reflection_prompt)
+            return self._parse_reflection(reflection.text, original_response)
+            
+        except Exception as e:
+            return self._fallback_result(original_response, e)
+    
+    def _build_reflection_prompt(self, original_query: str, original_response: str,
+                                 agent_type: str, conversation_history: list = None) -> str:
+        """Build the self-critique prompt"""
         
         reflection_prompt = f"""Bạn là chuyên gia đảm bảo chất lượng cho hệ thống học tiếng Anh.
 
@@ -24,10 +57,8 @@ class ReflectionAgent:
     """
         
         # Add conversation history for context
-        if conversation_history and len(conversation_history) > 0:
-            for msg in conversation_history[-4:]:  # Last 2 exchanges
-                role = "Học sinh" if msg["role"] == "user" else "Trợ lý"
-                reflection_prompt += f"{role}: {msg['content'][:100]}...\n"
+        if conversation_history:
+            reflection_prompt += format_history(conversation_history, 4, 100)  # Last 2 exchanges
         else:
             reflection_prompt += "(Không có lịch sử)\n"
         
@@ -58,60 +89,58 @@ class ReflectionAgent:
     Hãy nghiêm khắc nhưng công bằng. Chỉ đề xuất cải thiện khi thực sự cần thiết.
     """
         
-        try:
-            reflection = self.model.generate_content(reflection_prompt)
-            result = self._parse_reflection(reflection.text, original_response)
-            return result
-            
-        except Exception as e:
-            return {
-                "needs_improvement": False,
-                "critique": "",
-                "improved_response": original_response,
-                "confidence_score": 0.8,
-                "error": str(e)
-            }
+        return reflection_prompt
+    
+    def _fallback_result(self, original_response: str, error: Exception) -> Dict[str, Any]:
+        """Keep the original response when reflection fails"""
+        return {
+            "needs_improvement": False,
+            "critique": "",
+            "improved_response": original_response,
+            "confidence_score": 0.8,
+            "error": str(error)
+        }
+    
+    @with_retry(breaker=GEMINI_BREAKER)
+    def _generate(self, prompt: str):
+        """Call Gemini with retry/backoff"""
+        return self.model.generate_content(prompt)
     
     def _parse_reflection(self, reflection_text: str, original_response: str) -> Dict[str, Any]:
-        """Parse reflection output"""
+        """Parse reflection output (one regex pass over the field labels)"""
+        fields = {}
+        labels = list(_REFLECTION_FIELD_RE.finditer(reflection_text))
+        
+        for label, next_label in zip(labels, labels[1:] + [None]):
+            name = label.group(1)
+            if name in fields:
+                continue
+            
+            # Improved response runs to the end, even if it mentions other labels
+            if name == "Improved Response":
+                fields[name] = reflection_text[label.end():].strip()
+                break
+            
+            end = next_label.start() if next_label else len(reflection_text)
+            fields[name] = reflection_text[label.end():end].strip()
         
         # Extract confidence score
         confidence = 0.8  # Default
-        if "Confidence Score:" in reflection_text:
-            try:
-                conf_line = [l for l in reflection_text.split('\n') if 'Confidence Score:' in l][0]
-                confidence = float(conf_line.split(':')[1].strip())
-            except:
-                pass
+        conf_match = _NUMBER_RE.match(fields.get("Confidence Score", ""))
+        if conf_match:
+            confidence = float(conf_match.group())
         
         # Check if improvement needed
-        needs_improvement = "Needs Improvement: Yes" in reflection_text or "Needs Improvement: yes" in reflection_text
-        
-        # Extract critique
-        critique = ""
-        if "Critique:" in reflection_text:
-            try:
-                critique_start = reflection_text.find("Critique:") + len("Critique:")
-                critique_end = reflection_text.find("Improved Response:", critique_start)
-                if critique_end == -1:
-                    critique = reflection_text[critique_start:].strip()
-                else:
-                    critique = reflection_text[critique_start:critique_end].strip()
-            except:
-                pass
+        needs_improvement = fields.get("Needs Improvement", "").lower().startswith("yes")
         
         # Extract improved response
         improved_response = original_response
-        if needs_improvement and "Improved Response:" in reflection_text:
-            try:
-                improved_start = reflection_text.find("Improved Response:") + len("Improved Response:")
-                improved_response = reflection_text[improved_start:].strip()
-            except:
-                pass
+        if needs_improvement and "Improved Response" in fields:
+            improved_response = fields["Improved Response"]
         
         return {
             "needs_improvement": needs_improvement,
-            "critique": critique,
+            "critique": fields.get("Critique", ""),
             "improved_response": improved_response,
             "confidence_score": confidence
-        }
\ No newline at end of file
+        }
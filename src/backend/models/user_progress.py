@@ -3,31 +3,98 @@ Conversation History & User Progress Tracking System
 Stores conversations and tracks learning progress
 """
 
-import json
+import atexit
 import os
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
+from functools import lru_cache
+from itertools import chain
 from typing import List, Dict, Any
 from pathlib import Path
 import chromadb
+import numpy as np
+import orjson
 from chromadb.utils import embedding_functions
 
 
+# Persistent ChromaDB clients shared by every ConversationHistory (one per path)
+_CHROMA_CLIENTS: Dict[str, Any] = {}
+_CHROMA_LOCK = threading.Lock()
+
+
+def _get_chroma_client(path: Path):
+    """Open the persistent client for `path` once per process"""
+    key = str(path)
+    with _CHROMA_LOCK:
+        if key not in _CHROMA_CLIENTS:
+            path.mkdir(parents=True, exist_ok=True)
+            _CHROMA_CLIENTS[key] = chromadb.PersistentClient(path=key)
+        return _CHROMA_CLIENTS[key]
+
+
+# Background disk writes (one worker keeps them in submission order);
+# pending writes are drained before the interpreter exits
+_IO_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="progress-io")
+atexit.register(_IO_EXECUTOR.shutdown, wait=True)
+
+
+def _write_bytes(path: Path, data: bytes, append: bool = False):
+    with open(path, 'ab' if append else 'wb') as f:
+        f.write(data)
+
+
+def _report_write_error(future):
+    """Done-callback: a failed background write is printed instead of vanishing"""
+    error = future.exception()
+    if error is not None:
+        print(f"⚠️ Background write failed: {error}")
+
+
+def _submit_write(path: Path, data: bytes, append: bool = False):
+    """Queue a write on the I/O thread (errors are reported when it finishes)"""
+    _IO_EXECUTOR.submit(_write_bytes, path, data, append).add_done_callback(_report_write_error)
+
+
+def _add_pending(collection, docs: list, ids: list, metas: list):
+    """Add buffered messages to ChromaDB in a single call and empty the buffers"""
+    if not docs:
+        return
+    
+    collection.add(documents=list(docs), ids=list(ids), metadatas=list(metas))
+    del docs[:], ids[:], metas[:]
+
+
+@lru_cache(maxsize=1)
+def _get_embedder():
+    """Load all-MiniLM-L6-v2 once per process (shared by every user)"""
+    return embedding_functions.SentenceTransformerEmbeddingFunction(
+        model_name="all-MiniLM-L6-v2"
+    )
+
+
 class ConversationHistory:
     """
     Manages conversation history storage and retrieval
     Uses ChromaDB for semantic search over past conversations
     """
     
+    BATCH_SIZE = 16  # Messages embedded per ChromaDB add
+    
     def __init__(self, user_id: str, storage_dir: str = "../data/user_data"):
         self.user_id = user_id
         self.storage_dir = Path(storage_dir) / user_id
         self.storage_dir.mkdir(parents=True, exist_ok=True)
         
-        # ChromaDB for semantic conversation search
-        self.client = chromadb.Client()
-        self.embedding_function = embedding_functions.SentenceTransformerEmbeddingFunction(
-            model_name="all-MiniLM-L6-v2"
-        )
+        # Append-only message log (one JSON line per message)
+        self.messages_file = self.storage_dir / "messages.jsonl"
+        
+        # ChromaDB for semantic conversation search (index survives restarts;
+        # one client for all users, one collection per user)
+        self.client = _get_chroma_client(Path(storage_dir) / "chroma_db")
+        self.embedding_function = _get_embedder()
         
         self.collection = self.client.get_or_create_collection(
             name=f"conversations_{user_id}",
@@ -37,6 +104,35 @@ class ConversationHistory:
         # Current session messages
         self.current_session = []
         self.session_id = datetime.now().strftime("%Y%m%d_%H%M%S")
+        
+        # ChromaDB adds buffered until BATCH_SIZE or the end of a batch() block
+        self._batch_depth = 0
+        self._pending_docs, self._pending_ids, self._pending_meta = [], [], []
+        
+        # Index whatever is still buffered when the history goes away
+        self._finalizer = weakref.finalize(
+            self, _add_pending, self.collection,
+            self._pending_docs, self._pending_ids, self._pending_meta
+        )
+    
+    @contextmanager
+    def batch(self):
+        """Hold ChromaDB adds inside the block (flushed together at the end)"""
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            if self._batch_depth == 0:
+                self._flush_pending()
+    
+    def _maybe_flush(self):
+        if self._batch_depth == 0 and len(self._pending_docs) >= self.BATCH_SIZE:
+            self._flush_pending()
+    
+    def _flush_pending(self):
+        """Add buffered messages to ChromaDB in a single call"""
+        _add_pending(self.collection, self._pending_docs, self._pending_ids, self._pending_meta)
     
     def add_message(self, role: str, content: str, metadata: Dict[str, Any] = None):
         """
@@ -56,19 +152,24 @@ class ConversationHistory:
         
         self.current_session.append(message)
         
+        # Append to message log (O(1) write per message, off the request thread)
+        line = orjson.dumps({"session_id": self.session_id, **message},
+                            option=orjson.OPT_NON_STR_KEYS) + b"\n"
+        _submit_write(self.messages_file, line, append=True)
+        
         # Add to ChromaDB for semantic search
         doc_id = f"{self.session_id}_{len(self.current_session)}"
         
-        self.collection.add(
-            documents=[content],
-            ids=[doc_id],
-            metadatas=[{
-                "session_id": self.session_id,
-                "role": role,
-                "timestamp": message["timestamp"],
-                **message["metadata"]
-            }]
-        )
+        self._pending_docs.append(content)
+        self._pending_ids.append(doc_id)
+        self._pending_meta.append({
+            "session_id": self.session_id,
+            "role": role,
+            "timestamp": message["timestamp"],
+            **message["metadata"]
+        })
+        
+        self._maybe_flush()
     
     def get_current_session(self) -> List[Dict[str, Any]]:
         """Get all messages in current session"""
@@ -90,6 +191,9 @@ class ConversationHistory:
             List of relevant past messages
         """
         try:
+            # Make buffered messages searchable
+            self._flush_pending()
+            
             results = self.collection.query(
                 query_texts=[query],
                 n_results=n_results
@@ -99,20 +203,19 @@ class ConversationHistory:
                 return []
             
             # Format results
-            formatted = []
-            for doc, metadata, distance in zip(
-                results['documents'][0],
-                results['metadatas'][0],
-                results['distances'][0]
-            ):
-                formatted.append({
+            return [
+                {
                     "content": doc,
                     "metadata": metadata,
                     "relevance": 1 - distance,
                     "timestamp": metadata.get("timestamp", "N/A")
-                })
-            
-            return formatted
+                }
+                for doc, metadata, distance in zip(
+                    results['documents'][0],
+                    results['metadatas'][0],
+                    results['distances'][0]
+                )
+            ]
             
         except Exception as e:
             print(f"Error searching conversations: {e}")
@@ -120,6 +223,8 @@ class ConversationHistory:
     
     def save_session(self):
         """Save current session to JSON file"""
+        self._flush_pending()
+        
         if not self.current_session:
             return
         
@@ -134,8 +239,9 @@ class ConversationHistory:
             "ended_at": datetime.now().isoformat()
         }
         
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(session_data, f, indent=2, ensure_ascii=False)
+        # Serialize now (snapshot of the session), write in the background
+        data = orjson.dumps(session_data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+        _submit_write(filename, data)
         
         print(f"Session saved: {filename}")
     
@@ -149,25 +255,83 @@ class ConversationHistory:
 class UserProgressTracker:
     """
     Tracks user's learning progress
+    
+    Every change is appended as one line to progress.wal.jsonl; the full
+    progress.json is only rewritten when that log gets compacted.
     """
     
+    WAL_COMPACT_LINES = 200  # Fold the log into progress.json at this many entries
+    
     def __init__(self, user_id: str, storage_dir: str = "../data/user_data"):
         self.user_id = user_id
         self.storage_dir = Path(storage_dir) / user_id
         self.storage_dir.mkdir(parents=True, exist_ok=True)
         
         self.progress_file = self.storage_dir / "progress.json"
+        self.wal_file = self.storage_dir / "progress.wal.jsonl"
         
-        # Load existing progress or initialize
+        # Load the last snapshot, then replay logged changes on top
         self.progress = self._load_progress()
+        self._build_indexes()
+        self._wal_lines = self._replay_wal()
+        
+        self._batch_depth = 0
+        self._wal = open(self.wal_file, 'ab', buffering=0)
+        
+        # Entries are durable once written; just close the log when the tracker goes away
+        self._finalizer = weakref.finalize(self, self._wal.close)
+    
+    @contextmanager
+    def batch(self):
+        """Defer log compaction until the end of the block"""
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            if self._batch_depth == 0:
+                self.flush()
     
     def _load_progress(self) -> Dict[str, Any]:
-        """Load progress from file"""
+        """Load progress from file (a new user's initial snapshot is written right away)"""
         if self.progress_file.exists():
-            with open(self.progress_file, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        else:
-            return self._initialize_progress()
+            with open(self.progress_file, 'rb') as f:
+                return orjson.loads(f.read())
+        
+        # Persist now so created_at doesn't change on every load until the first compaction
+        progress = self._initialize_progress()
+        self._write_json_atomic(self.progress_file, progress)
+        return progress
+    
+    def _replay_wal(self) -> int:
+        """Re-apply logged changes newer than the snapshot; returns the log length"""
+        if not self.wal_file.exists():
+            return 0
+        
+        lines = 0
+        with open(self.wal_file, 'rb') as f:
+            for line in f:
+                try:
+                    entry = orjson.loads(line)
+                except orjson.JSONDecodeError:
+                    continue  # Torn last line after a crash
+                
+                lines += 1
+                # Entries already in the snapshot (crash between compaction steps) are skipped
+                if entry["seq"] > self.progress.get("wal_seq", 0):
+                    self._apply(entry, verbose=False)
+                    self.progress["wal_seq"] = entry["seq"]
+        
+        return lines
+    
+    def _build_indexes(self):
+        """Dict indexes over the progress lists for O(1) lookups (records are shared, not copied)"""
+        self._vocab_index = {w["word"].lower(): w
+                             for w in self.progress["vocabulary"]["learned_words"]}
+        self._grammar_index = {t["topic"].lower(): t
+                               for t in self.progress["grammar"]["topics_studied"]}
+        self._mistake_index = {m["mistake_type"]: m
+                               for m in self.progress["mistakes"]["common_mistakes"]}
     
     def _initialize_progress(self) -> Dict[str, Any]:
         """Initialize new progress structure"""
@@ -207,43 +371,105 @@ class UserProgressTracker:
             }
         }
     
-    def save_progress(self):
-        """Save progress to file"""
-        self.progress["last_updated"] = datetime.now().isoformat()
+    def _write_json_atomic(self, path: Path, data: Dict[str, Any]):
+        """Write JSON to a temp file and swap it in with os.replace"""
+        tmp_path = path.with_name(path.name + ".tmp")
+        with open(tmp_path, 'wb') as f:
+            f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+        os.replace(tmp_path, path)
+    
+    def _record(self, op: str, **fields):
+        """Apply a change in memory and append it to the log (O(1) write)"""
+        entry = {"op": op, "ts": datetime.now().isoformat(), **fields}
+        self._apply(entry)
+        
+        entry["seq"] = self.progress["wal_seq"] = self.progress.get("wal_seq", 0) + 1
+        self._wal.write(orjson.dumps(entry) + b"\n")
+        self._wal_lines += 1
         
-        with open(self.progress_file, 'w', encoding='utf-8') as f:
-            json.dump(self.progress, f, indent=2, ensure_ascii=False)
+        if self._batch_depth == 0:
+            self.flush()
+    
+    def _apply(self, entry: Dict[str, Any], verbose: bool = True):
+        """Apply one logged change to the in-memory progress"""
+        op, ts = entry["op"], entry["ts"]
+        
+        if op == "query":
+            self.progress["statistics"]["total_queries"] += 1
+        elif op == "vocab":
+            self._upsert_vocabulary(entry["word"], entry.get("metadata"), ts)
+        elif op == "grammar":
+            self._upsert_grammar_topic(entry["topic"], entry["mastery_level"], ts, verbose)
+        elif op == "mistake":
+            self._upsert_mistake(entry["mistake_type"], entry["example"], ts)
+        elif op == "exercise":
+            self._add_exercise(entry["exercise_id"], entry["topic"], entry["score"], ts)
+        
+        self.progress["last_updated"] = ts
+    
+    def flush(self, force: bool = False):
+        """Compact the log into progress.json once it is long enough (or force)"""
+        if self._wal_lines and (force or self._wal_lines >= self.WAL_COMPACT_LINES):
+            self._compact()
+    
+    def save_progress(self):
+        """Save progress to file now (deferred while inside batch())"""
+        if self._batch_depth == 0:
+            self._compact()
+    
+    def _compact(self):
+        """Rewrite progress.json from memory and truncate the log"""
+        self._write_json_atomic(self.progress_file, self.progress)
+        
+        # The snapshot now holds everything (its wal_seq marks the last entry).
+        # Truncated in place: the append-mode handle (and its finalizer) stay valid
+        self._wal.truncate(0)
+        self._wal_lines = 0
     
     def increment_query_count(self):
         """Increment total queries"""
-        self.progress["statistics"]["total_queries"] += 1
-        self.save_progress()
+        self._record("query")
     
     def add_vocabulary(self, word: str, metadata: Dict[str, Any] = None):
         """Add word to learned vocabulary"""
-        existing = next((w for w in self.progress["vocabulary"]["learned_words"] 
-                        if w["word"].lower() == word.lower()), None)
+        self._record("vocab", word=word, metadata=metadata or {})
+    
+    def add_vocabulary_bulk(self, words: List[str], metadata: Dict[str, Any] = None):
+        """Add several words (compaction checked once)"""
+        with self.batch():
+            for word in words:
+                self._record("vocab", word=word, metadata=metadata or {})
+    
+    def _upsert_vocabulary(self, word: str, metadata: Dict[str, Any] = None, ts: str = None):
+        """Add or review a word in memory (no save)"""
+        ts = ts or datetime.now().isoformat()
+        existing = self._vocab_index.get(word.lower())
         
         if existing:
             existing["times_reviewed"] += 1
-            existing["last_reviewed"] = datetime.now().isoformat()
+            existing["last_reviewed"] = ts
         else:
-            self.progress["vocabulary"]["learned_words"].append({
+            record = {
                 "word": word,
-                "learned_at": datetime.now().isoformat(),
+                "learned_at": ts,
                 "times_reviewed": 1,
                 "metadata": metadata or {}
-            })
+            }
+            self.progress["vocabulary"]["learned_words"].append(record)
+            self._vocab_index[word.lower()] = record
             self.progress["statistics"]["vocabulary_learned"] += 1
-        
-        self.save_progress()
     
     def add_grammar_topic(self, topic: str, mastery_level: float = 0.6):
         """Add or update a grammar topic with progressive mastery"""
+        self._record("grammar", topic=topic, mastery_level=mastery_level)
+    
+    def _upsert_grammar_topic(self, topic: str, mastery_level: float = 0.6,
+                              ts: str = None, verbose: bool = True):
+        """Add or update a grammar topic in memory (no save)"""
+        ts = ts or datetime.now().isoformat()
         
         # Tìm topic đã tồn tại trong list
-        existing = next((t for t in self.progress["grammar"]["topics_studied"]
-                        if t["topic"].lower() == topic.lower()), None)
+        existing = self._grammar_index.get(topic.lower())
         
         if existing:
             # Topic đã học rồi → Tăng mastery lên 10%
@@ -251,55 +477,62 @@ class UserProgressTracker:
             new_mastery = min(current_mastery + 0.1, 1.0)  # Max 100%
             
             existing["mastery_level"] = new_mastery
-            existing["last_studied"] = datetime.now().isoformat()
+            existing["last_studied"] = ts
             existing["times_studied"] += 1
             
-            print(f"📈 Updated '{topic}': {current_mastery:.0%} → {new_mastery:.0%}")
+            if verbose:
+                print(f"📈 Updated '{topic}': {current_mastery:.0%} → {new_mastery:.0%}")
         else:
             # Topic mới → Thêm vào list với mastery mặc định
-            self.progress["grammar"]["topics_studied"].append({
+            record = {
                 "topic": topic,
-                "studied_at": datetime.now().isoformat(),
-                "last_studied": datetime.now().isoformat(),
+                "studied_at": ts,
+                "last_studied": ts,
                 "mastery_level": mastery_level,
                 "times_studied": 1
-            })
+            }
+            self.progress["grammar"]["topics_studied"].append(record)
+            self._grammar_index[topic.lower()] = record
             self.progress["statistics"]["grammar_topics_covered"] += 1
             
-            print(f"✨ New topic '{topic}': {mastery_level:.0%}")
-        
-        self.save_progress()
+            if verbose:
+                print(f"✨ New topic '{topic}': {mastery_level:.0%}")
     
     def record_mistake(self, mistake_type: str, example: str):
         """Record a common mistake"""
-        existing = next((m for m in self.progress["mistakes"]["common_mistakes"]
-                        if m["mistake_type"] == mistake_type), None)
+        self._record("mistake", mistake_type=mistake_type, example=example)
+    
+    def _upsert_mistake(self, mistake_type: str, example: str, ts: str):
+        existing = self._mistake_index.get(mistake_type)
         
         if existing:
             existing["count"] += 1
             existing["examples"].append({
                 "example": example,
-                "timestamp": datetime.now().isoformat()
+                "timestamp": ts
             })
             existing["examples"] = existing["examples"][-5:]
         else:
-            self.progress["mistakes"]["common_mistakes"].append({
+            record = {
                 "mistake_type": mistake_type,
                 "count": 1,
                 "examples": [{
                     "example": example,
-                    "timestamp": datetime.now().isoformat()
+                    "timestamp": ts
                 }]
-            })
-        
-        self.save_progress()
+            }
+            self.progress["mistakes"]["common_mistakes"].append(record)
+            self._mistake_index[mistake_type] = record
     
     def record_exercise_completion(self, exercise_id: str, topic: str, score: float):
         """Record completed exercise"""
+        self._record("exercise", exercise_id=exercise_id, topic=topic, score=score)
+    
+    def _add_exercise(self, exercise_id: str, topic: str, score: float, ts: str):
         self.progress["exercises"]["completed"].append({
             "exercise_id": exercise_id,
             "topic": topic,
-            "completed_at": datetime.now().isoformat(),
+            "completed_at": ts,
             "score": score
         })
         
@@ -311,23 +544,28 @@ class UserProgressTracker:
             self.progress["exercises"]["scores_by_topic"][topic][-10:]
         
         self.progress["statistics"]["exercises_completed"] += 1
-        
-        self.save_progress()
     
     def get_weak_topics(self, threshold: float = 0.6) -> List[str]:
         """Get topics where user scored below threshold"""
-        weak_topics = []
-        
-        for topic, scores in self.progress["exercises"]["scores_by_topic"].items():
-            avg_score = sum(scores) / len(scores)
-            if avg_score < threshold:
-                weak_topics.append({
-                    "topic": topic,
-                    "avg_score": avg_score,
-                    "attempts": len(scores)
-                })
+        scores_by_topic = {t: s for t, s in self.progress["exercises"]["scores_by_topic"].items() if s}
+        if not scores_by_topic:
+            return []
         
-        return sorted(weak_topics, key=lambda x: x["avg_score"])
+        # Flatten the ragged score lists and average each topic's segment in one pass
+        topics = list(scores_by_topic)
+        counts = np.fromiter(map(len, scores_by_topic.values()), dtype=np.int64, count=len(topics))
+        flat = np.fromiter(chain.from_iterable(scores_by_topic.values()), dtype=np.float64,
+                           count=int(counts.sum()))
+        offsets = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        means = np.add.reduceat(flat, offsets) / counts
+        
+        weak = np.flatnonzero(means < threshold)
+        weak = weak[np.argsort(means[weak], kind="stable")]
+        
+        return [
+            {"topic": topics[i], "avg_score": float(means[i]), "attempts": int(counts[i])}
+            for i in weak
+        ]
     
     def get_recommendations(self) -> Dict[str, Any]:
         """Get personalized learning recommendations"""
@@ -341,18 +579,20 @@ class UserProgressTracker:
         from datetime import datetime, timedelta
         week_ago = (datetime.now() - timedelta(days=7)).isoformat()
         
-        for word_data in self.progress["vocabulary"]["learned_words"]:
-            if word_data.get("last_reviewed", word_data["learned_at"]) < week_ago:
-                recommendations["vocabulary_to_review"].append(word_data["word"])
-        
-        # Weak grammar topics
-        weak_topics = self.get_weak_topics(threshold=0.7)
-        recommendations["grammar_topics_to_practice"] = [t["topic"] for t in weak_topics[:3]]
-        
-        # Topics with low mastery
-        for topic_data in self.progress["grammar"]["topics_studied"]:
-            if topic_data["mastery_level"] < 0.7:
-                recommendations["grammar_topics_to_practice"].append(topic_data["topic"])
+        words = self.progress["vocabulary"]["learned_words"]
+        if words:
+            last_seen = np.array([w.get("last_reviewed", w["learned_at"]) for w in words],
+                                 dtype="datetime64[us]")
+            stale = np.flatnonzero(last_seen < np.datetime64(week_ago))
+            recommendations["vocabulary_to_review"] = [words[i]["word"] for i in stale]
+        
+        # Weak grammar topics, then topics with low mastery
+        # (ordered dict keys: a topic that is both is listed once)
+        to_practice = dict.fromkeys(t["topic"] for t in self.get_weak_topics(threshold=0.7)[:3])
+        to_practice.update(dict.fromkeys(
+            t["topic"] for t in self.progress["grammar"]["topics_studied"] if t["mastery_level"] < 0.7
+        ))
+        recommendations["grammar_topics_to_practice"] = list(to_practice)
         
         return recommendations
     
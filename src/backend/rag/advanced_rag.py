@@ -3,14 +3,227 @@ Advanced RAG System - Compatible with existing data structure
 Loads from: data/vocab/, data/grammar/, data/exercise/
 """
 
-import os
-import json
-import glob
-from typing import List, Dict, Any
+import re
+import hashlib
+import queue
+import threading
+from bisect import bisect_left
+from itertools import accumulate
+from typing import List, Dict, Any, Iterator
+import ijson
+import numpy as np
+import orjson
 import chromadb
 from chromadb.utils import embedding_functions
 from pathlib import Path
-import PyPDF2
+import pymupdf
+
+from backend.utils.retry import with_retry, CHROMA_BREAKER
+
+
+BATCH_SIZE = 200  # Documents per collection.add call when loading
+BULK_BATCH_SIZE = 5000  # Same, for the first full load (capped by the client's max batch size)
+EMBED_BATCH_SIZE = 64  # Texts per encoder forward pass
+ADD_WORKERS = 2  # Concurrent embed + collection.add writers (more just contend on SQLite)
+MAX_PDF_PAGES = 50  # Pages read per grammar PDF
+_WORD_RE = re.compile(r'\w+')
+
+
+def _chunk_text(text: str, chunk_size: int = 500) -> List[str]:
+    """Split text into chunks of roughly chunk_size characters"""
+    words = text.split()
+    
+    # ends[i] = length of words[:i+1], one trailing space per word
+    ends = list(accumulate(len(word) + 1 for word in words))
+    
+    chunks = []
+    start, offset = 0, 0
+    while start < len(words):
+        # A chunk closes on the first word that brings it to chunk_size
+        end = bisect_left(ends, offset + chunk_size, lo=start) + 1
+        chunks.append(' '.join(words[start:end]))
+        if end < len(words):
+            offset = ends[end - 1]
+        start = end
+    
+    return chunks
+
+
+def _text_digest(text: str) -> str:
+    """Stable 64-bit content hash for document ids (builtin hash() is salted per process)"""
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=8).hexdigest()
+
+
+def _token_string(text: str) -> str:
+    """Sorted unique lowercase word tokens, space-joined (Chroma metadata must be scalar)"""
+    return " ".join(sorted(set(_WORD_RE.findall(text.lower()))))
+
+
+def _doc_tokens(result: Dict[str, Any]) -> List[str]:
+    """Word tokens for a search result: precomputed at insert, or tokenized now for older collections"""
+    tokens = (result.get("metadata") or {}).get("tokens")
+    if tokens is not None:
+        return tokens.split()
+    return _WORD_RE.findall(result["document"].lower())
+
+
+def _json_root(f) -> bytes:
+    """First significant byte of a JSON file (b'[' or b'{'), rewinding afterwards"""
+    head = f.read(64).lstrip()
+    f.seek(0)
+    return head[:1]
+
+
+def _stream_vocab_items(f) -> Iterator[Dict[str, Any]]:
+    """Yield vocab entries one at a time from a list, {"words": [...]} or single-object file"""
+    if _json_root(f) == b'[':
+        yield from ijson.items(f, 'item', use_float=True)
+        return
+    
+    found = False
+    for item in ijson.items(f, 'words.item', use_float=True):
+        found = True
+        yield item
+    
+    if not found:
+        f.seek(0)
+        yield from ijson.items(f, '', use_float=True)
+
+
+def _stream_exercise_items(f) -> Iterator[Dict[str, Any]]:
+    """Yield exercises from a list root, or from each list/dict value of a dict root"""
+    if _json_root(f) == b'[':
+        yield from ijson.items(f, 'item', use_float=True)
+        return
+    
+    for key, value in ijson.kvitems(f, '', use_float=True):
+        if isinstance(value, list):
+            yield from value
+        elif isinstance(value, dict):
+            yield value
+
+
+def _extract_page(doc, page_num: int) -> List[str]:
+    """Extract and chunk one page of an open PDF (empty if unreadable or near-blank)"""
+    try:
+        text = doc[page_num].get_text("text")
+    except Exception:
+        return []
+    
+    if len(text.strip()) < 100:
+        return []
+    
+    return _chunk_text(text, chunk_size=500)
+
+
+class _BatchAdder:
+    """
+    Buffers documents and adds them to a collection BATCH_SIZE at a time
+    
+    Full batches are embedded and written by ADD_WORKERS background threads,
+    so the loader keeps parsing the next batch meanwhile. Call close() at the end;
+    it returns how many documents were actually written.
+    """
+    
+    def __init__(self, collection, batch_size: int = BATCH_SIZE, embed=None, seen_texts: set = None,
+                 workers: int = ADD_WORKERS):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.workers = workers
+        self.embed = embed  # Optional texts -> embeddings; Chroma embeds itself if None
+        self.seen_texts = seen_texts if seen_texts is not None else set()  # Digests of documents already added
+        self._docs, self._ids, self._metas, self._digests = [], [], [], []
+        self._seen_ids = set()
+        
+        self._lock = threading.Lock()  # Guards the counters and seen_texts across writers
+        self.accepted = 0
+        self.failed = 0
+        
+        # Bounded: parsing stays at most 2 batches ahead of the writers
+        self._queue = queue.Queue(maxsize=2)
+        self._writers = []
+    
+    def add(self, document: str, doc_id: str, metadata: Dict[str, Any]):
+        """Queue a document (duplicates are skipped)"""
+        # Chroma rejects a whole add() with a repeated id (single adds just skipped it)
+        if doc_id in self._seen_ids:
+            return
+        
+        # Identical text under another id: skip the embedding and insert
+        digest = _text_digest(" ".join(document.lower().split()))
+        with self._lock:
+            if digest in self.seen_texts:
+                return
+            self.seen_texts.add(digest)
+        
+        self._docs.append(document)
+        self._ids.append(doc_id)
+        self._digests.append(digest)
+        # Reranking reads these instead of re-tokenizing the document per query
+        self._metas.append({**metadata, "tokens": _token_string(document)})
+        self._seen_ids.add(doc_id)
+        
+        if len(self._docs) >= self.batch_size:
+            self.flush()
+    
+    def flush(self):
+        """Hand the buffered documents to the writer threads"""
+        if not self._docs:
+            return
+        
+        if not self._writers:
+            self._writers = [threading.Thread(target=self._write_loop, daemon=True)
+                             for _ in range(self.workers)]
+            for writer in self._writers:
+                writer.start()
+        
+        self._queue.put((self._docs, self._ids, self._metas, self._digests))
+        
+        self._docs, self._ids, self._metas, self._digests = [], [], [], []
+        self._seen_ids.clear()
+    
+    def close(self) -> int:
+        """Flush, wait until every batch has been written and return the accepted count"""
+        self.flush()
+        
+        for _ in self._writers:
+            self._queue.put(None)
+        for writer in self._writers:
+            writer.join()
+        self._writers = []
+        
+        if self.failed:
+            print(f"   ⚠️ {self.failed} documents could not be added")
+        return self.accepted
+    
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            self._write(*item)
+    
+    def _write(self, docs: List[str], ids: List[str], metas: List[Dict[str, Any]],
+               digests: List[str]):
+        embeddings = None
+        if self.embed is not None:
+            try:
+                embeddings = self.embed(docs)
+            except Exception as e:
+                print(f"   ⚠️ Batch embedding failed, falling back to Chroma: {e}")
+        
+        try:
+            self.collection.add(documents=docs, ids=ids, metadatas=metas, embeddings=embeddings)
+        except Exception as e:
+            print(f"   ✗ Error adding batch of {len(docs)} documents: {e}")
+            # Not stored: let a later load retry these texts
+            with self._lock:
+                self.failed += len(docs)
+                self.seen_texts.difference_update(digests)
+            return
+        
+        with self._lock:
+            self.accepted += len(docs)
 
 
 class AdvancedRAG:
@@ -27,6 +240,9 @@ class AdvancedRAG:
     def __init__(self, data_dir: str = "../data"):
         """Initialize RAG system with data directory"""
         self.data_dir = Path(data_dir)
+        self._encoder = None  # Loaded only if documents need indexing
+        self._encoder_lock = threading.Lock()  # Batch writers may ask for it concurrently
+        self._seen_texts = set()  # Document digests added during this load (shared by all loaders)
         
         # Use PersistentClient
         persist_dir = Path("./chroma_db")
@@ -34,18 +250,19 @@ class AdvancedRAG:
         
         self.client = chromadb.PersistentClient(path=str(persist_dir))
         
-        # Try to get existing collection
+        # Try to get existing (non-empty) collection
         try:
             self.collection = self.client.get_collection(name="english_learning")
+            if self.collection.count() == 0:
+                # Previous first load never added anything: build again
+                raise ValueError("Existing collection is empty")
             print("✅ Using existing ChromaDB collection")
             self._skip_loading = True
             
             # NEW: Load cached stats from file
             stats_file = persist_dir / "stats.json"
             if stats_file.exists():
-                import json
-                with open(stats_file, 'r', encoding='utf-8') as f:
-                    self._cached_stats = json.load(f)
+                self._cached_stats = orjson.loads(stats_file.read_bytes())
                 print(f"✓ Loaded stats from cache: {self._cached_stats['total']} documents")
             else:
                 print("⚠️ No stats cache found - will calculate on first query")
@@ -53,13 +270,25 @@ class AdvancedRAG:
                 
         except:
             print("📦 Creating new ChromaDB collection...")
-            self.collection = self.client.create_collection(
+            self.collection = self.client.get_or_create_collection(
                 name="english_learning",
                 metadata={"description": "English learning content"}
             )
             self._skip_loading = False
             self._cached_stats = None
     
+    def _new_batch(self) -> "_BatchAdder":
+        """Batch writer for a loader (large batches on first load: one SQLite commit each)"""
+        batch_size = BATCH_SIZE
+        if not self._skip_loading:
+            try:
+                batch_size = min(BULK_BATCH_SIZE, self.client.get_max_batch_size())
+            except Exception:
+                pass
+        
+        return _BatchAdder(self.collection, batch_size=batch_size, embed=self._embed_documents,
+                           seen_texts=self._seen_texts)
+    
     def load_all_data(self) -> Dict[str, int]:
         """Load all data from existing structure"""
         
@@ -75,11 +304,9 @@ class AdvancedRAG:
                 
                 # Calculate breakdown (only once, then cached)
                 try:
-                    all_metadata = self.collection.get(limit=count)['metadatas']
-                    
-                    vocab_count = sum(1 for m in all_metadata if m.get('source') == 'vocabulary')
-                    grammar_count = sum(1 for m in all_metadata if m.get('source') == 'grammar')
-                    exercise_count = sum(1 for m in all_metadata if m.get('source') == 'exercise')
+                    vocab_count = self._count_source("vocabulary")
+                    grammar_count = self._count_source("grammar")
+                    exercise_count = self._count_source("exercise")
                     
                     stats = {
                         "total": count,
@@ -140,93 +367,97 @@ class AdvancedRAG:
         return stats
 
 
+    def _embed_documents(self, texts: List[str]) -> np.ndarray:
+        """Batched all-MiniLM-L6-v2 embeddings (same model as Chroma's default query embedder)"""
+        with self._encoder_lock:
+            if self._encoder is None:
+                from sentence_transformers import SentenceTransformer
+                self._encoder = SentenceTransformer("all-MiniLM-L6-v2")
+        
+        return self._encoder.encode(
+            texts,
+            batch_size=EMBED_BATCH_SIZE,
+            convert_to_numpy=True,
+            normalize_embeddings=True
+        )
+    
+    def _count_source(self, source: str) -> int:
+        """Documents with metadata source == source (ids only, no documents/metadata payload)"""
+        # collection.count() takes no where filter
+        return len(self.collection.get(where={"source": source}, include=[])['ids'])
+    
     def _save_stats_cache(self, stats: Dict[str, int]):
         """Save statistics to cache file"""
         try:
-            import json
             stats_file = Path("./chroma_db/stats.json")
-            with open(stats_file, 'w', encoding='utf-8') as f:
-                json.dump(stats, f, indent=2)
+            stats_file.write_bytes(orjson.dumps(stats, option=orjson.OPT_INDENT_2))
             print("💾 Statistics cached to disk")
         except Exception as e:
             print(f"⚠️ Failed to cache stats: {e}")
     
     def _load_vocabulary(self, vocab_dir: Path) -> int:
         """Load vocabulary JSON files"""
-        count = 0
+        batch = self._new_batch()
         
-        for json_file in glob.glob(str(vocab_dir / "*.json")):
+        for json_file in vocab_dir.glob("*.json"):
             try:
-                with open(json_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                
-                # Handle different JSON structures
-                if isinstance(data, list):
-                    vocab_list = data
-                elif isinstance(data, dict) and "words" in data:
-                    vocab_list = data["words"]
-                else:
-                    vocab_list = [data]
-                
-                for idx, item in enumerate(vocab_list):
-                    # Flexible structure handling
-                    word = item.get("word", item.get("headword", "unknown"))
-                    
-                    # Build searchable text
-                    text_parts = [f"Word: {word}"]
-                    
-                    if "class" in item:
-                        text_parts.append(f"Part of Speech: {item['class']}")
-                    
-                    if "level" in item:
-                        text_parts.append(f"Level: {item['level']}")
-                    
-                    # Definitions
-                    if "definitions" in item:
-                        for defn in item.get("definitions", [])[:3]:  # Max 3
-                            if isinstance(defn, dict):
-                                text_parts.append(f"Definition: {defn.get('definition', '')}")
-                            else:
-                                text_parts.append(f"Definition: {defn}")
-                    
-                    # Spanish translation if available
-                    if "spanish" in item:
-                        text_parts.append(f"Spanish: {item['spanish']}")
-                    
-                    text = "\n".join(text_parts)
-                    
-                    # Add to collection
-                    doc_id = f"vocab_{word.lower()}_{idx}"
-                    
-                    self.collection.add(
-                        documents=[text],
-                        ids=[doc_id],
-                        metadatas=[{
+                # Stream items instead of materializing the whole file
+                with json_file.open('rb') as f:
+                    n_items = 0
+                    for idx, item in enumerate(_stream_vocab_items(f)):
+                        n_items += 1
+                        
+                        # Flexible structure handling
+                        word = item.get("word", item.get("headword", "unknown"))
+                        
+                        # Build searchable text
+                        text_parts = [f"Word: {word}"]
+                        
+                        if "class" in item:
+                            text_parts.append(f"Part of Speech: {item['class']}")
+                        
+                        if "level" in item:
+                            text_parts.append(f"Level: {item['level']}")
+                        
+                        # Definitions
+                        if "definitions" in item:
+                            for defn in item.get("definitions", [])[:3]:  # Max 3
+                                if isinstance(defn, dict):
+                                    text_parts.append(f"Definition: {defn.get('definition', '')}")
+                                else:
+                                    text_parts.append(f"Definition: {defn}")
+                        
+                        # Spanish translation if available
+                        if "spanish" in item:
+                            text_parts.append(f"Spanish: {item['spanish']}")
+                        
+                        text = "\n".join(text_parts)
+                        
+                        # Add to collection
+                        doc_id = f"vocab_{word.lower()}_{idx}"
+                        
+                        batch.add(text, doc_id, {
                             "source": "vocabulary",
                             "word": word,
                             "level": item.get("level", "unknown"),
-                            "file": os.path.basename(json_file)
-                        }]
-                    )
-                    
-                    count += 1
+                            "file": json_file.name
+                        })
                 
-                print(f"   ✓ Loaded {len(vocab_list)} words from {os.path.basename(json_file)}")
+                print(f"   ✓ Loaded {n_items} words from {json_file.name}")
                 
             except Exception as e:
                 print(f"   ✗ Error loading {json_file}: {e}")
         
-        return count
+        return batch.close()
     
     def _load_grammar_pdfs(self, grammar_dir: Path) -> int:
         """Load grammar from PDFs AND JSON files"""
-        count = 0
+        batch = self._new_batch()
         
         # 1. Load JSON files (CoEdIT)
-        for json_file in glob.glob(str(grammar_dir / "*.json")):
+        for json_file in grammar_dir.glob("*.json"):
             try:
-                with open(json_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
+                data = orjson.loads(json_file.read_bytes())
                 
                 # Handle list of grammar examples
                 if isinstance(data, list):
@@ -251,166 +482,117 @@ class AdvancedRAG:
                         continue
                     
                     text = "\n".join(text_parts)
-                    doc_id = f"grammar_json_{idx}_{hash(text) % 10000}"
+                    doc_id = f"grammar_json_{idx}_{_text_digest(text)}"
                     
-                    self.collection.add(
-                        documents=[text],
-                        ids=[doc_id],
-                        metadatas=[{
-                            "source": "grammar",
-                            "type": "correction",
-                            "file": os.path.basename(json_file)
-                        }]
-                    )
-                    count += 1
+                    batch.add(text, doc_id, {
+                        "source": "grammar",
+                        "type": "correction",
+                        "file": json_file.name
+                    })
                 
-                print(f"   ✓ Loaded {len(grammar_items)} examples from {os.path.basename(json_file)}")
+                print(f"   ✓ Loaded {len(grammar_items)} examples from {json_file.name}")
             
             except Exception as e:
                 print(f"   ✗ Error loading {json_file}: {e}")
         
         # 2. Load PDFs (backward compatibility)
-        for pdf_file in glob.glob(str(grammar_dir / "*.pdf")):
+        for pdf_file in grammar_dir.glob("*.pdf"):
             try:
-                print(f"   Loading PDF: {os.path.basename(pdf_file)}...")
+                print(f"   Loading PDF: {pdf_file.name}...")
                 
-                with open(pdf_file, 'rb') as file:
-                    pdf_reader = PyPDF2.PdfReader(file)
-                    
-                    max_pages = min(50, len(pdf_reader.pages))
-                    
-                    for page_num in range(max_pages):
-                        try:
-                            page = pdf_reader.pages[page_num]
-                            text = page.extract_text()
-                            
-                            if len(text.strip()) < 100:
+                # One open document for all pages (MuPDF extraction is fast enough in-process)
+                with pymupdf.open(pdf_file) as doc:
+                    for page_num in range(min(MAX_PDF_PAGES, doc.page_count)):
+                        for chunk_idx, chunk in enumerate(_extract_page(doc, page_num)):
+                            if len(chunk.strip()) < 50:
                                 continue
                             
-                            chunks = self._chunk_text(text, chunk_size=500)
+                            doc_id = f"grammar_pdf_p{page_num}_c{chunk_idx}"
                             
-                            for chunk_idx, chunk in enumerate(chunks):
-                                if len(chunk.strip()) < 50:
-                                    continue
-                                
-                                doc_id = f"grammar_pdf_p{page_num}_c{chunk_idx}"
-                                
-                                self.collection.add(
-                                    documents=[chunk],
-                                    ids=[doc_id],
-                                    metadatas=[{
-                                        "source": "grammar",
-                                        "type": "pdf",
-                                        "page": page_num + 1,
-                                        "file": os.path.basename(pdf_file)
-                                    }]
-                                )
-                                
-                                count += 1
-                        
-                        except Exception as e:
-                            continue
+                            batch.add(chunk, doc_id, {
+                                "source": "grammar",
+                                "type": "pdf",
+                                "page": page_num + 1,
+                                "file": pdf_file.name
+                            })
                 
                 print(f"   ✓ Loaded chunks from PDF")
                 
             except Exception as e:
                 print(f"   ✗ Error loading PDF {pdf_file}: {e}")
         
-        return count
+        return batch.close()
     
     def _load_exercises(self, exercise_dir: Path) -> int:
         """Load exercise JSON files - UPDATED to support Trivia format"""
-        count = 0
+        batch = self._new_batch()
         
-        for json_file in glob.glob(str(exercise_dir / "*.json")):
+        for json_file in exercise_dir.glob("*.json"):
             try:
-                with open(json_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                
-                # Handle different structures
-                if isinstance(data, list):
-                    exercises = data
-                elif isinstance(data, dict):
-                    exercises = []
-                    for key, value in data.items():
-                        if isinstance(value, list):
-                            exercises.extend(value)
-                        elif isinstance(value, dict):
-                            exercises.append(value)
-                
-                for idx, exercise in enumerate(exercises):
-                    # Build searchable text
-                    text_parts = []
-                    
-                    # NEW: Handle trivia format
-                    if "question" in exercise and "correct_answer" in exercise:
-                        text_parts.append(f"Question: {exercise['question']}")
-                        text_parts.append(f"Answer: {exercise['correct_answer']}")
+                # Stream items instead of materializing the whole file
+                with json_file.open('rb') as f:
+                    n_items = 0
+                    for idx, exercise in enumerate(_stream_exercise_items(f)):
+                        n_items += 1
                         
-                        if "incorrect_answers" in exercise:
-                            all_options = [exercise['correct_answer']] + exercise['incorrect_answers']
-                            text_parts.append(f"Options: {', '.join(all_options)}")
+                        # Build searchable text
+                        text_parts = []
                         
-                        if "category" in exercise:
-                            text_parts.append(f"Category: {exercise['category']}")
-                    
-                    # OLD: Handle original format (compatibility)
-                    elif "sentence" in exercise:
-                        text_parts.append(f"Sentence: {exercise['sentence']}")
-                    
-                    if "topic" in exercise:
-                        text_parts.append(f"Topic: {exercise['topic']}")
-                    
-                    if "explanation" in exercise:
-                        text_parts.append(f"Explanation: {exercise['explanation']}")
-                    
-                    if not text_parts:
-                        continue
-                    
-                    text = "\n".join(text_parts)
-                    
-                    doc_id = f"exercise_{idx}_{hash(text) % 10000}"
-                    
-                    self.collection.add(
-                        documents=[text],
-                        ids=[doc_id],
-                        metadatas=[{
+                        # NEW: Handle trivia format
+                        if "question" in exercise and "correct_answer" in exercise:
+                            text_parts.append(f"Question: {exercise['question']}")
+                            text_parts.append(f"Answer: {exercise['correct_answer']}")
+                            
+                            if "incorrect_answers" in exercise:
+                                all_options = [exercise['correct_answer']] + exercise['incorrect_answers']
+                                text_parts.append(f"Options: {', '.join(all_options)}")
+                            
+                            if "category" in exercise:
+                                text_parts.append(f"Category: {exercise['category']}")
+                        
+                        # OLD: Handle original format (compatibility)
+                        elif "sentence" in exercise:
+                            text_parts.append(f"Sentence: {exercise['sentence']}")
+                        
+                        if "topic" in exercise:
+                            text_parts.append(f"Topic: {exercise['topic']}")
+                        
+                        if "explanation" in exercise:
+                            text_parts.append(f"Explanation: {exercise['explanation']}")
+                        
+                        if not text_parts:
+                            continue
+                        
+                        text = "\n".join(text_parts)
+                        
+                        doc_id = f"exercise_{idx}_{_text_digest(text)}"
+                        
+                        batch.add(text, doc_id, {
                             "source": "exercise",
                             "topic": exercise.get("topic", exercise.get("category", "general")),
                             "type": exercise.get("type", "multiple_choice"),
-                            "file": os.path.basename(json_file)
-                        }]
-                    )
-                    
-                    count += 1
+                            "file": json_file.name
+                        })
                 
-                print(f"   ✓ Loaded {len(exercises)} exercises from {os.path.basename(json_file)}")
+                print(f"   ✓ Loaded {n_items} exercises from {json_file.name}")
                 
             except Exception as e:
                 print(f"   ✗ Error loading {json_file}: {e}")
         
-        return count
+        return batch.close()
     
     def _chunk_text(self, text: str, chunk_size: int = 500) -> List[str]:
         """Split text into chunks"""
-        words = text.split()
-        chunks = []
-        current_chunk = []
-        current_length = 0
-        
-        for word in words:
-            current_chunk.append(word)
-            current_length += len(word) + 1
-            
-            if current_length >= chunk_size:
-                chunks.append(' '.join(current_chunk))
-                current_chunk = []
-                current_length = 0
-        
-        if current_chunk:
-            chunks.append(' '.join(current_chunk))
-        
-        return chunks
+        return _chunk_text(text, chunk_size)
+    
+    @with_retry(breaker=CHROMA_BREAKER)
+    def _query(self, query: str, n_results: int, where_filter: Dict[str, Any] = None):
+        """Query ChromaDB with retry/backoff"""
+        return self.collection.query(
+            query_texts=[query],
+            n_results=n_results,
+            where=where_filter
+        )
     
     def search(self, query: str, n_results: int = 5,
                filter_source: str = None) -> Dict[str, Any]:
@@ -418,11 +600,7 @@ class AdvancedRAG:
         try:
             where_filter = {"source": filter_source} if filter_source else None
             
-            results = self.collection.query(
-                query_texts=[query],
-                n_results=n_results,
-                where=where_filter
-            )
+            results = self._query(query, n_results, where_filter)
             
             if not results['documents'] or not results['documents'][0]:
                 return {"success": False, "results": []}
@@ -454,19 +632,29 @@ class AdvancedRAG:
             return initial
         
         # Rerank
-        query_keywords = set(query.lower().split())
+        query_keywords = set(_WORD_RE.findall(query.lower()))
+        results = initial["results"]
+        
+        # Whole-word overlap against the tokens stored at insert time
+        keyword_matches = np.fromiter(
+            (len(query_keywords.intersection(_doc_tokens(r))) for r in results),
+            dtype=np.int64, count=len(results)
+        )
+        scores = np.fromiter((r["score"] for r in results), dtype=np.float64, count=len(results))
+        combined_scores = scores + keyword_matches * 0.1
         
-        for result in initial["results"]:
-            doc_lower = result["document"].lower()
-            keyword_matches = sum(1 for kw in query_keywords if kw in doc_lower)
-            result["keyword_matches"] = keyword_matches
-            result["combined_score"] = result["score"] + (keyword_matches * 0.1)
+        # Sort (stable, descending) and return top-k
+        order = np.argsort(-combined_scores, kind="stable")[:n_results]
         
-        # Sort and return top-k
-        initial["results"].sort(key=lambda x: x["combined_score"], reverse=True)
+        top_results = []
+        for idx in order:
+            result = results[idx]
+            result["keyword_matches"] = int(keyword_matches[idx])
+            result["combined_score"] = float(combined_scores[idx])
+            top_results.append(result)
         
         return {
             "success": True,
-            "results": initial["results"][:n_results],
+            "results": top_results,
             "reranking_applied": True
         }
\ No newline at end of file
@@ -0,0 +1,127 @@
+"""
+Retry & Circuit Breaker utilities
+Exponential backoff for transient Gemini/ChromaDB errors
+"""
+
+import threading
+import time
+from functools import wraps
+
+from google.api_core import exceptions as google_exceptions
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
+
+
+# Errors worth retrying (rate limits, overloaded service, network blips)
+RETRYABLE_EXCEPTIONS = (
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.DeadlineExceeded,
+    ConnectionError,
+    TimeoutError,
+)
+
+
+class CircuitOpenError(Exception):
+    """Raised when a circuit breaker is open and calls are short-circuited"""
+
+
+class CircuitBreaker:
+    """
+    Stops calling a failing service for a while
+
+    After `fail_threshold` consecutive outage-type failures (RETRYABLE_EXCEPTIONS)
+    the circuit opens and every call fails immediately with CircuitOpenError
+    until `reset_s` seconds pass. Other errors (bad request, bad key) propagate
+    without counting.
+    """
+
+    def __init__(self, name: str, fail_threshold: int = 5, reset_s: float = 120):
+        self.name = name
+        self.fail_threshold = fail_threshold
+        self.reset_s = reset_s
+
+        self._failures = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        """Circuit is open and still inside its reset period (no state change)"""
+        with self._lock:
+            return (self._opened_at is not None and
+                    time.monotonic() - self._opened_at < self.reset_s)
+    
+    def allow(self) -> bool:
+        """Check whether a call may go through"""
+        with self._lock:
+            if self._opened_at is None:
+                return True
+
+            # Half-open: let one call through after the reset period
+            if time.monotonic() - self._opened_at >= self.reset_s:
+                self._opened_at = None
+                self._failures = self.fail_threshold - 1
+                return True
+
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.fail_threshold:
+                self._opened_at = time.monotonic()
+
+    def _check(self):
+        if not self.allow():
+            raise CircuitOpenError(
+                f"{self.name} is temporarily unavailable, please try again in a moment"
+            )
+
+    def __call__(self, func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            self._check()
+            try:
+                result = func(*args, **kwargs)
+            except RETRYABLE_EXCEPTIONS:
+                self.record_failure()
+                raise
+
+            self.record_success()
+            return result
+
+        return wrapper
+
+
+# Shared breakers (one per external service)
+GEMINI_BREAKER = CircuitBreaker("Gemini API")
+CHROMA_BREAKER = CircuitBreaker("Knowledge base")
+
+
+def with_retry(tries: int = 3, base: float = 1, max_wait: float = 60,
+               breaker: CircuitBreaker = None):
+    """
+    Retry transient errors with exponential backoff
+
+    Args:
+        tries: Total attempts
+        base: First backoff in seconds (doubles each retry)
+        max_wait: Backoff cap in seconds
+        breaker: Optional circuit breaker wrapping the retried call
+    """
+    def decorator(func):
+        retrying = retry(
+            retry=retry_if_exception_type(RETRYABLE_EXCEPTIONS),
+            stop=stop_after_attempt(tries),
+            wait=wait_exponential(multiplier=base, max=max_wait),
+            reraise=True
+        )(func)
+
+        return breaker(retrying) if breaker else retrying
+
+    return decorator
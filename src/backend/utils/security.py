@@ -26,6 +26,16 @@ class InputSanitizer:
         r"disregard\s+your",
     ]
     
+    # All patterns in one alternation: a single scan per input, group name -> pattern index
+    _COMBINED_DANGEROUS = re.compile(
+        '|'.join(f'(?P<p{i}>{p})' for i, p in enumerate(DANGEROUS_PATTERNS)),
+        re.IGNORECASE
+    )
+    
+    # Basic XSS markers, matched case-insensitively in one pass
+    XSS_MARKERS = ['<script>', '</script>', '<iframe>', 'javascript:']
+    _XSS_RE = re.compile('|'.join(map(re.escape, XSS_MARKERS)), re.IGNORECASE)
+    
     MAX_LENGTH = 1000  # Max input length
     
     @staticmethod
@@ -40,6 +50,10 @@ class InputSanitizer:
         if not user_input or not user_input.strip():
             return "", False, "Empty input"
         
+        # Fast path: a short single ASCII word cannot match any pattern
+        if len(user_input) < 32 and user_input.isascii() and user_input.isalnum():
+            return user_input, True, None
+        
         original_length = len(user_input)
         
         # 1. Check length
@@ -50,19 +64,17 @@ class InputSanitizer:
             warning = None
         
         # 2. Check for dangerous patterns
-        input_lower = user_input.lower()
-        for pattern in InputSanitizer.DANGEROUS_PATTERNS:
-            if re.search(pattern, input_lower):
-                return "", False, f"⚠️ Suspicious pattern detected: '{pattern}'. Input blocked for security."
+        match = InputSanitizer._COMBINED_DANGEROUS.search(user_input)
+        if match:
+            pattern = InputSanitizer.DANGEROUS_PATTERNS[int(match.lastgroup[1:])]
+            return "", False, f"⚠️ Suspicious pattern detected: '{pattern}'. Input blocked for security."
         
         # 3. Remove excessive whitespace
         user_input = re.sub(r'\s+', ' ', user_input).strip()
         
         # 4. Basic XSS prevention (for web display)
-        dangerous_chars = ['<script>', '</script>', '<iframe>', 'javascript:']
-        for char in dangerous_chars:
-            if char in user_input.lower():
-                return "", False, f"⚠️ Potentially malicious content detected. Input blocked."
+        if InputSanitizer._XSS_RE.search(user_input):
+            return "", False, f"⚠️ Potentially malicious content detected. Input blocked."
         
         return user_input, True, warning
     
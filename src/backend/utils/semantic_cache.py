@@ -0,0 +1,101 @@
+"""
+Semantic Response Cache
+Reuses agent responses for near-duplicate questions (random-projection LSH + cosine)
+"""
+
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from typing import Optional
+
+import numpy as np
+
+
+class SemanticResponseCache:
+    """
+    Caches responses keyed on the query embedding
+
+    Each embedding is hashed into `n_tables` buckets of `n_bits` random hyperplanes;
+    a lookup only compares against entries sharing a bucket, then checks exact cosine.
+    """
+
+    def __init__(self, threshold: float = 0.95,
+                 n_tables: int = 4, n_bits: int = 8,
+                 ttl_s: float = 24 * 3600, max_entries: int = 1000, seed: int = 42):
+        """
+        Args:
+            threshold: Minimum cosine similarity for a hit
+            n_tables: Independent hash tables (more tables = better recall)
+            n_bits: Hyperplanes per table (more bits = smaller buckets)
+            ttl_s: Entry lifetime in seconds
+            max_entries: Oldest entries are evicted beyond this size
+        """
+        self.threshold = threshold
+        self.n_tables = n_tables
+        self.n_bits = n_bits
+        self.ttl_s = ttl_s
+        self.max_entries = max_entries
+        self.seed = seed
+
+        self._planes = None  # Built on first use, once the embedding size is known
+        self._bit_weights = 1 << np.arange(n_bits)
+
+        # entry_id -> (embedding, response, agent_type, timestamp), oldest first
+        self._entries = OrderedDict()
+        # (agent_type, table, hash) -> [entry_id, ...]
+        self._buckets = defaultdict(list)
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def _hashes(self, vec: np.ndarray):
+        if self._planes is None:
+            rng = np.random.default_rng(self.seed)
+            self._planes = rng.standard_normal(
+                (self.n_tables, self.n_bits, vec.shape[0])
+            ).astype(np.float32)
+
+        bits = (self._planes @ vec) > 0  # (n_tables, n_bits)
+        return (bits @ self._bit_weights).tolist()
+
+    def get(self, vec: np.ndarray, agent_type: str) -> Optional[str]:
+        """Best cached response with cosine >= threshold, or None"""
+        now = time.time()
+        best, best_sim = None, self.threshold
+
+        with self._lock:
+            for table, h in enumerate(self._hashes(vec)):
+                bucket = self._buckets.get((agent_type, table, h))
+                if not bucket:
+                    continue
+
+                # Drop ids evicted since they were bucketed
+                bucket[:] = [i for i in bucket if i in self._entries]
+
+                for entry_id in bucket:
+                    embedding, response, _, timestamp = self._entries[entry_id]
+                    if now - timestamp > self.ttl_s:
+                        continue
+
+                    sim = float(embedding @ vec)
+                    if sim >= best_sim:
+                        best, best_sim = response, sim
+
+        return best
+
+    def put(self, vec: np.ndarray, agent_type: str, response: str):
+        """Store a response under the query embedding"""
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+
+            self._entries[entry_id] = (vec, response, agent_type, time.time())
+            for table, h in enumerate(self._hashes(vec)):
+                self._buckets[(agent_type, table, h)].append(entry_id)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._buckets.clear()
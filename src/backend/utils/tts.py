@@ -5,19 +5,79 @@ Converts text to speech for pronunciation practice
 
 from gtts import gTTS
 import os
+import wave
+import tempfile
+import hashlib
+from io import BytesIO
 from pathlib import Path
 import base64
 
+try:
+    from piper import PiperVoice, SynthesisConfig
+except ImportError:  # piper-tts not installed: gTTS only
+    PiperVoice = None
+
+
+DEFAULT_VOICE = "../data/voices/en_US-lessac-medium.onnx"
+
 
 class TextToSpeechEngine:
     """
-    Text-to-Speech engine using gTTS (Google Text-to-Speech)
-    Free and works offline after download
+    Text-to-Speech engine using a local Piper voice (ONNX), falling back to
+    gTTS (Google Text-to-Speech) when no voice model is available
     """
     
-    def __init__(self, output_dir: str = "../data/audio"):
+    def __init__(self, output_dir: str = "../data/audio", voice_model: str = DEFAULT_VOICE):
         self.output_dir = Path(output_dir)
         self.output_dir.mkdir(parents=True, exist_ok=True)
+        
+        # Generated audio, keyed by (text, lang, slow, accent)
+        self._cache_dir = self.output_dir / "cache"
+        self._cache_dir.mkdir(parents=True, exist_ok=True)
+        
+        # Local synthesis avoids a network round-trip per call
+        self.voice = None
+        if PiperVoice is not None and Path(voice_model).exists():
+            try:
+                self.voice = PiperVoice.load(voice_model)
+                print(f"✅ Piper voice loaded: {Path(voice_model).name}")
+            except Exception as e:
+                print(f"⚠️ Piper voice failed to load, using gTTS: {e}")
+        
+        self.mime_type = "audio/wav" if self.voice else "audio/mp3"
+    
+    def _cache_path(self, text: str, lang: str, slow: bool, accent: str) -> Path:
+        key = hashlib.blake2b(f"{text}|{lang}|{slow}|{accent}".encode('utf-8'),
+                              digest_size=16).hexdigest()
+        ext = "wav" if self._use_piper(lang) else "mp3"
+        return self._cache_dir / f"{key}.{ext}"
+    
+    def _use_piper(self, lang: str) -> bool:
+        # The Piper voice is English only
+        return self.voice is not None and lang == 'en'
+    
+    def _synthesize(self, text: str, lang: str, slow: bool, accent: str) -> bytes:
+        """Audio bytes for text, from disk cache, Piper (WAV) or gTTS (MP3)"""
+        cache_path = self._cache_path(text, lang, slow, accent)
+        if cache_path.exists():
+            return cache_path.read_bytes()
+        
+        audio_bytes = BytesIO()
+        if self._use_piper(lang):
+            syn_config = SynthesisConfig(length_scale=1.5 if slow else None)
+            with wave.open(audio_bytes, "wb") as wav_file:
+                self.voice.synthesize_wav(text, wav_file, syn_config=syn_config)
+        else:
+            gTTS(text=text, lang=lang, tld=accent, slow=slow).write_to_fp(audio_bytes)
+        data = audio_bytes.getvalue()
+        
+        # Write to a unique temp file then rename, so readers never see a partial
+        # file and concurrent sessions synthesizing the same text don't collide
+        with tempfile.NamedTemporaryFile(dir=self._cache_dir, suffix=".tmp", delete=False) as tmp:
+            tmp.write(data)
+        os.replace(tmp.name, cache_path)
+        
+        return data
     
     def text_to_speech(self, text: str, lang: str = 'en', 
                        accent: str = 'com', slow: bool = False) -> str:
@@ -34,13 +94,10 @@ class TextToSpeechEngine:
             Path to generated audio file
         """
         try:
-            # Generate filename
-            filename = f"tts_{hash(text) % 10000}.mp3"
-            filepath = self.output_dir / filename
-            
-            # Generate speech
-            tts = gTTS(text=text, lang=lang, tld=accent, slow=slow)
-            tts.save(str(filepath))
+            # Cached file doubles as the output file
+            filepath = self._cache_path(text, lang, slow, accent)
+            if not filepath.exists():
+                self._synthesize(text, lang, slow, accent)
             
             return str(filepath)
             
@@ -48,9 +105,9 @@ class TextToSpeechEngine:
             print(f"TTS Error: {e}")
             return None
     
-    def text_to_speech_base64(self, text: str, slow: bool = False, max_duration_seconds: int = 30) -> str:
+    def text_to_speech_bytes(self, text: str, slow: bool = False, max_duration_seconds: int = 30) -> bytes:
         """
-        Convert text to speech and return base64 encoded audio
+        Convert text to speech and return the raw audio bytes (format: self.mime_type)
         
         Args:
             text: Text to convert
@@ -58,7 +115,7 @@ class TextToSpeechEngine:
             max_duration_seconds: Maximum audio duration (default 30s)
         
         Returns:
-            Base64 encoded audio string
+            Audio bytes
         """
         try:
             # Estimate duration: ~2.5 words per second (normal), ~1.5 words/s (slow)
@@ -71,24 +128,31 @@ class TextToSpeechEngine:
                 text = ' '.join(words[:max_words]) + "..."
                 print(f"⚠️ Text truncated to {max_words} words (~{max_duration_seconds}s)")
             
-            # Generate TTS
-            tts = gTTS(text=text, lang='en', slow=slow)
-            
-            # Save to BytesIO instead of file
-            from io import BytesIO
-            audio_bytes = BytesIO()
-            tts.write_to_fp(audio_bytes)
-            audio_bytes.seek(0)
-            
-            # Encode to base64
-            audio_base64 = base64.b64encode(audio_bytes.read()).decode('utf-8')
-            
-            return audio_base64
+            # Generate TTS (or reuse cached audio)
+            return self._synthesize(text, 'en', slow, 'com')
         
         except Exception as e:
             print(f"TTS Error: {e}")
             return None
     
+    def text_to_speech_base64(self, text: str, slow: bool = False, max_duration_seconds: int = 30) -> str:
+        """
+        Convert text to speech and return base64 encoded audio (for embedding in HTML)
+        
+        Args:
+            text: Text to convert
+            slow: Speak slowly for learning
+            max_duration_seconds: Maximum audio duration (default 30s)
+        
+        Returns:
+            Base64 encoded audio string
+        """
+        audio_bytes = self.text_to_speech_bytes(text, slow, max_duration_seconds)
+        if audio_bytes is None:
+            return None
+        
+        return base64.b64encode(audio_bytes).decode('ascii')
+    
     def pronounce_word(self, word: str, slow: bool = True) -> str:
         """
         Generate pronunciation for a single word
@@ -117,19 +181,20 @@ class TextToSpeechEngine:
 
 
 # For Streamlit integration
-def create_audio_player_html(audio_base64: str) -> str:
+def create_audio_player_html(audio_base64: str, mime_type: str) -> str:
     """
     Create HTML audio player for Streamlit
     
     Args:
         audio_base64: Base64 encoded audio
+        mime_type: Audio MIME type - pass TextToSpeechEngine.mime_type (WAV for Piper, MP3 for gTTS)
     
     Returns:
         HTML string with audio player
     """
     html = f"""
     <audio controls autoplay>
-        <source src="data:audio/mp3;base64,{audio_base64}" type="audio/mp3">
+        <source src="data:{mime_type};base64,{audio_base64}" type="{mime_type}">
         Your browser does not support the audio element.
     </audio>
     """
@@ -5,6 +5,8 @@
 
 import json
 import requests
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from datasets import load_dataset  # type: ignore
 import time
@@ -34,33 +36,72 @@ def download_coedit():
     print(f"   ✓ Saved {len(grammar_data)} grammar examples to {output}")
     return len(grammar_data)
 
+TRIVIA_URL = "https://opentdb.com/api.php"
+TRIVIA_BATCHES = 50  # 50 batches x 50 questions = 2500 questions
+TRIVIA_MIN_INTERVAL = 5.0  # opentdb allows ~1 request / 5s per IP
+
+
+def _make_throttle(min_interval: float):
+    """Spaces request starts min_interval apart across threads"""
+    lock = threading.Lock()
+    next_slot = [0.0]
+    
+    def wait():
+        with lock:
+            now = time.monotonic()
+            slot = max(now, next_slot[0])
+            next_slot[0] = slot + min_interval
+        time.sleep(slot - now)
+    
+    return wait
+
+def _fetch_trivia_batch(session, token, throttle):
+    """One batch of 50 questions (retries when rate limited)"""
+    for _ in range(3):
+        throttle()
+        response = session.get(TRIVIA_URL, params={"amount": 50, "type": "multiple", "token": token}, timeout=30)
+        data = response.json()
+        if data["response_code"] != 5:  # 5 = rate limited
+            return data
+    return data
+
 def download_trivia():
     """Download OpenTriviaQA"""
     print("\n📥 [2/2] Downloading Trivia Questions (Exercises - 2.5K examples)...")
     
     exercises = []
     
-    for i in range(50):  # 50 batches x 50 questions = 2500 questions
-        url = f"https://opentdb.com/api.php?amount=50&type=multiple"
-        try:
-            response = requests.get(url)
-            data = response.json()
-            
-            if data["response_code"] == 0:
-                for item in data["results"]:
-                    exercises.append({
-                        "question": item["question"],
-                        "correct_answer": item["correct_answer"],
-                        "incorrect_answers": item["incorrect_answers"],
-                        "category": item["category"],
-                        "difficulty": item["difficulty"],
-                        "type": item["type"]
-                    })
-            
-            if (i + 1) % 10 == 0:
-                print(f"   Downloaded {len(exercises)} questions...")
-        except:
-            continue
+    # One keep-alive connection; the session token stops repeated questions across batches
+    session = requests.Session()
+    try:
+        token = session.get("https://opentdb.com/api_token.php", params={"command": "request"}, timeout=30).json()["token"]
+    except Exception:
+        token = None
+    
+    throttle = _make_throttle(TRIVIA_MIN_INTERVAL)
+    
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        futures = [executor.submit(_fetch_trivia_batch, session, token, throttle) for _ in range(TRIVIA_BATCHES)]
+        
+        for i, future in enumerate(as_completed(futures)):
+            try:
+                data = future.result()
+                
+                if data["response_code"] == 0:
+                    for item in data["results"]:
+                        exercises.append({
+                            "question": item["question"],
+                            "correct_answer": item["correct_answer"],
+                            "incorrect_answers": item["incorrect_answers"],
+                            "category": item["category"],
+                            "difficulty": item["difficulty"],
+                            "type": item["type"]
+                        })
+                
+                if (i + 1) % 10 == 0:
+                    print(f"   Downloaded {len(exercises)} questions...")
+            except:
+                continue
     
     # Save
     output = Path("../../data/exercise/trivia_exercises.json") 